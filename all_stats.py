@@ -1,20 +1,34 @@
 import json
+import multiprocessing
 import os
 import shutil
+from functools import lru_cache
 
 import matplotlib as mpl
 import numpy as np
 import tqdm
 from PIL import Image, ImageDraw, ImageFont
 
+import cloud_cover
+import dewpoint
+import mean_daily_stats
+import precipitation
+import stats_store
+import windspeed
 from cloud_cover import compute_cloud_segment_overall
+from constants import date_end_str, date_start_str
 from dewpoint import aggregated_humidity_related_values
 from mean_daily_stats import temperature_stats_dict
 from precipitation import precipitation_stats_dict
+from scheduler import run_jobs
 from windspeed import high_wind_days
 
 output_folder = "output"
 images_folder = "images"
+store_path = stats_store.default_store_path
+
+# viridis as uint8 RGBA, indexed like matplotlib's 256 entry colormap
+colormap_lut = (mpl.cm.viridis(np.linspace(0, 1, 256)) * 255).astype(np.uint8)
 
 
 def all_stats():
@@ -27,6 +41,21 @@ def all_stats():
     }
 
 
+def cache_jobs():
+    """Cache population jobs for every statistic in `all_stats`."""
+    return [
+        *cloud_cover.cache_jobs(),
+        *windspeed.cache_jobs(),
+        *dewpoint.cache_jobs(),
+        *precipitation.cache_jobs(),
+        *mean_daily_stats.cache_jobs(),
+    ]
+
+
+def populate_caches(**kwargs):
+    run_jobs(cache_jobs(), **kwargs)
+
+
 def save_to_npz(statname, stat):
     stat = stat.astype(np.float32)
     try:
@@ -48,16 +77,34 @@ def save_image(statname, stat, unit):
         "%": (0, 1),
         "m": (0, np.percentile(stat, 95)),
     }[unit]
-    stat = (stat - low) / (hi - low)
-    img = Image.fromarray((mpl.cm.viridis(stat) * 255).astype(np.uint8))
+    stat = (np.asarray(stat, dtype=np.float64) - low) / (hi - low)
+    img = Image.fromarray(apply_colormap(stat))
     draw_title(statname, img)
     img.save(f"{images_folder}/{statname}.png")
 
 
+def apply_colormap(normalized):
+    """RGBA uint8 image of values scaled to [0, 1], using `colormap_lut`.
+
+    Matches `mpl.cm.viridis`: values outside [0, 1] are clipped and NaNs are
+    transparent.
+    """
+    bad = np.isnan(normalized)
+    index = np.clip(np.nan_to_num(normalized) * 256, 0, 255).astype(np.uint8)
+    rgba = colormap_lut[index]
+    rgba[bad] = 0
+    return rgba
+
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    return ImageFont.truetype("Arial.ttf", size)
+
+
 def draw_title(statname, img):
     draw = ImageDraw.Draw(img)
     # make the text large and centered at the top
-    font = ImageFont.truetype("Arial.ttf", 48)
+    font = load_font(48)
     bbox = draw.textbbox((0, 0), statname, font=font)
     text_width = bbox[2] - bbox[0]
     draw.text(
@@ -78,19 +125,38 @@ def run_ffmpeg_monthly():
     )
 
 
-def main():
+def save_outputs(statname, stat, unit):
+    save_to_npz(statname, stat)
+    save_image(statname, stat, unit)
+    return statname
+
+
+def main(processes=None):
     shutil.rmtree(output_folder, ignore_errors=True)
     shutil.rmtree(images_folder, ignore_errors=True)
     stats = all_stats()
     with open("stats_listing.json", "w") as f:
         json.dump(list(stats), f, indent=2)
-    for statname, (stat, unit) in tqdm.tqdm(stats.items()):
+    for statname, (stat, unit) in stats.items():
         assert stat.shape == (
             180 * 4,
             360 * 4,
         ), f"Unexpected shape for {statname}: {stat.shape}"
-        save_to_npz(statname, stat)
-        save_image(statname, stat, unit)
+    # rendering and compression are independent per stat
+    with multiprocessing.Pool(processes) as pool:
+        results = [
+            pool.apply_async(save_outputs, (statname, stat, unit))
+            for statname, (stat, unit) in stats.items()
+        ]
+        for result in tqdm.tqdm(results):
+            result.get()
+    stats_store.write_store(
+        store_path,
+        stats,
+        metadata=dict(
+            date_start=date_start_str, date_end=date_end_str, listing=list(stats)
+        ),
+    )
     run_ffmpeg_monthly()
 
 
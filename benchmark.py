@@ -0,0 +1,246 @@
+"""Per-stage benchmarks for the stats pipeline, run against `fake_ee`.
+
+    python benchmark.py run [--output results.json]
+    python benchmark.py compare old.json new.json
+
+Each stage is run on representative 720x1440 inputs and reports wall time,
+peak traced memory and throughput. Results are saved as JSON, by default to
+`benchmark_results/<commit>.json`, so runs from different commits can be
+compared.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+import fake_ee
+
+results_folder = "benchmark_results"
+
+
+def measure(function, repeat):
+    """Best and mean wall time over `repeat` runs, then peak memory of one run."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), sum(times) / len(times), peak
+
+
+def synthetic_stat(seed, low=250, high=310):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(low, high, size=(180 * 4, 360 * 4)).astype(np.float32)
+
+
+def stages(args):
+    """Dictionary from stage name to (setup, items, unit).
+
+    `setup()` is run once, untimed, and returns the function to time.
+    """
+    import all_stats
+    import dewpoint
+    import download
+    import heat_index
+
+    date_str = "2005-07-01"
+
+    def tile_fetch():
+        fake_ee.configure(latency=args.latency)
+        image = dewpoint.high_temp_image(date_str)
+        return lambda: download.download_ee_image(
+            image,
+            "maximum_2m_air_temperature",
+            pbar=False,
+            max_workers=args.max_workers,
+        )
+
+    def tile_merge():
+        fake_ee.configure(latency=0)
+        tiles = download.generate_tiles(45, resolution=0.25)
+        grid = synthetic_stat(0)
+        tile_data = [
+            grid[download.tile_slices(bounds, 0.25)].tolist() for bounds in tiles
+        ]
+        return lambda: download.merge_tiles(tile_data, 45)
+
+    def aggregation():
+        fake_ee.configure(latency=0)
+        # fill the (temporary) per-date caches, so only aggregation is timed
+        dewpoint.humidity_reduction.function(args.dates)
+        return lambda: dewpoint.humidity_reduction.function(args.dates)
+
+    def compute_heat_index():
+        temp, dewpoint_k = synthetic_stat(1, 280, 315), synthetic_stat(2, 260, 300)
+        dewpoint_k = np.minimum(temp, dewpoint_k)
+        return lambda: heat_index.compute_heat_index(temp, dewpoint_k)
+
+    def save_to_npz():
+        stat = synthetic_stat(3)
+        return lambda: all_stats.save_to_npz("benchmark", stat)
+
+    def save_image():
+        stat = synthetic_stat(4)
+        return lambda: all_stats.save_image("benchmark", stat, "K")
+
+    def ffmpeg():
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("ffmpeg not found")
+        for month in range(1, 13):
+            all_stats.save_image(
+                f"maxdaily_temp_month_{month:02d}", synthetic_stat(month), "K"
+            )
+        return all_stats.run_ffmpeg_monthly
+
+    return {
+        "tile_fetch": (tile_fetch, 32, "tiles"),
+        "tile_merge": (tile_merge, 1, "images"),
+        "aggregation": (aggregation, args.dates, "dates"),
+        "compute_heat_index": (compute_heat_index, 180 * 4 * 360 * 4, "pixels"),
+        "save_to_npz": (save_to_npz, 1, "stats"),
+        "save_image": (save_image, 1, "stats"),
+        "ffmpeg": (ffmpeg, 12, "frames"),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args):
+    import permacache.cache
+
+    commit = git_commit()
+    output = os.path.abspath(args.output or f"{results_folder}/{commit}.json")
+    workdir = tempfile.mkdtemp(prefix="weather-agg-benchmark-")
+    # run in a scratch directory with its own caches, never the real ones
+    permacache.cache.CACHE = os.path.join(workdir, "cache")
+    fake_ee.install(disable_cache=False)
+    previous_cwd = os.getcwd()
+    os.chdir(workdir)
+    report = dict(
+        commit=commit,
+        timestamp=datetime.now().isoformat(),
+        python=platform.python_version(),
+        numpy=np.__version__,
+        platform=platform.platform(),
+        parameters=vars(args),
+        stages={},
+    )
+    try:
+        for name, (setup, items, unit) in stages(args).items():
+            if args.stages and name not in args.stages:
+                continue
+            print(f"Benchmarking {name}...", file=sys.stderr)
+            try:
+                best, mean, peak = measure(setup(), args.repeat)
+            except Exception as e:
+                report["stages"][name] = dict(error=repr(e))
+                print(f"  skipped: {e!r}", file=sys.stderr)
+                continue
+            report["stages"][name] = dict(
+                wall_time_s=best,
+                mean_wall_time_s=mean,
+                peak_memory_mb=peak / 2**20,
+                items=items,
+                unit=unit,
+                throughput_per_s=items / best,
+            )
+            print(
+                f"  {best:.3f}s, {peak / 2**20:.1f} MB,"
+                f" {items / best:.4g} {unit}/s",
+                file=sys.stderr,
+            )
+    finally:
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {output}", file=sys.stderr)
+    return report
+
+
+def compare(old_path, new_path, threshold=1.1):
+    """Print the change in each stage between two result files.
+
+    Returns:
+        list: Names of the stages whose time or memory grew by more than
+            `threshold` times
+    """
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'stage':<20} {'time':>22} {'peak memory':>24}")
+    regressions = []
+    for name in sorted(set(old["stages"]) | set(new["stages"])):
+        before, after = old["stages"].get(name, {}), new["stages"].get(name, {})
+        if "wall_time_s" not in before or "wall_time_s" not in after:
+            print(f"{name:<20} {'(missing or failed)':>22}")
+            continue
+        time_ratio = after["wall_time_s"] / before["wall_time_s"]
+        memory_ratio = after["peak_memory_mb"] / max(before["peak_memory_mb"], 1e-9)
+        flag = ""
+        if time_ratio > threshold or memory_ratio > threshold:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(
+            f"{name:<20}"
+            f" {before['wall_time_s']:8.3f}s -> {after['wall_time_s']:8.3f}s"
+            f" {before['peak_memory_mb']:8.1f}MB -> {after['peak_memory_mb']:8.1f}MB"
+            f"{flag}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run")
+    run_parser.add_argument("--output", help="JSON file to write results to")
+    run_parser.add_argument("--stages", nargs="*", help="Only run these stages")
+    run_parser.add_argument("--repeat", type=int, default=3)
+    run_parser.add_argument("--dates", type=int, default=20)
+    run_parser.add_argument(
+        "--latency", type=float, default=0.05, help="Fake seconds per request"
+    )
+    run_parser.add_argument("--max-workers", type=int, default=4)
+    compare_parser = subparsers.add_parser("compare")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument("--threshold", type=float, default=1.1)
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(1 if compare(args.old, args.new, args.threshold) else 0)
+
+
+if __name__ == "__main__":
+    main()
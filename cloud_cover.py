@@ -1,11 +1,16 @@
-from datetime import datetime, timedelta
-
 import ee
-from permacache import drop_if_equal, permacache
+from permacache import permacache
 
-from constants import date_end_str, date_start_str
-from download import download_ee_image
-from mean_daily_stats import decrement
+from constants import date_start_str, date_stop_str
+from download import (
+    download_ee_image,
+    is_image_cached,
+    is_too_expensive_error,
+    remove_journal,
+)
+from instrumentation import instrumented
+from scheduler import job_group
+from segments import decompose, plan_units, split_on_failure, weighted_mean
 
 # def high_temp_over_90f():
 #     ee.Initialize()
@@ -15,11 +20,8 @@ from mean_daily_stats import decrement
 #     return data.mean()
 
 
-@permacache(
-    "weather-agg-ee/cloud_cover/cloud_cover_for_segment",
-)
-def cloud_cover_for_segment(date_start_str, date_end_str):
-    print(f"Cloud cover {date_start_str} to {date_end_str}")
+def cloud_cover_image(date_start_str, date_end_str):
+    """Mean fraction of sunny hours over `[date_start_str, date_end_str)`."""
     ee.Initialize()
     era5 = ee.ImageCollection("ECMWF/ERA5/HOURLY")
     day = era5.filter(
@@ -36,25 +38,85 @@ def cloud_cover_for_segment(date_start_str, date_end_str):
             },
         )
     )
-    return download_ee_image(day.mean(), "sun", resolution=0.25, degree_size=45)
+    return day.mean()
+
+
+@instrumented
+def cloud_cover_for_segment(date_start_str, date_end_str):
+    """Cached by its computation, see `download.download_ee_image_by_computation`."""
+    print(f"Cloud cover {date_start_str} to {date_end_str}")
+    return download_ee_image(
+        cloud_cover_image(date_start_str, date_end_str),
+        "sun",
+        resolution=0.25,
+        degree_size=45,
+        journal=True,
+        cache=True,
+    )
+
+
+def cloud_cover_cached(date_start_str, date_end_str):
+    return is_image_cached(cloud_cover_image(date_start_str, date_end_str), "sun")
+
+
+# years of hourly data; segments are cached per year, so decades would not reuse them
+cloud_cover_units = plan_units("ECMWF/ERA5/HOURLY")
+
+
+def cloud_cover_for_range(date_start_str, date_end_str):
+    """cloud_cover_for_segment, halving the range while it is too expensive."""
+    return split_on_failure(
+        cloud_cover_for_segment,
+        date_start_str,
+        date_end_str,
+        is_too_expensive_error,
+        on_split=lambda start, end: remove_journal(
+            cloud_cover_image(start, end), "sun", resolution=0.25
+        ),
+    )
+
+
+def cloud_cover_segments(date_start_str=date_start_str, date_stop_str=date_stop_str):
+    return decompose(
+        date_start_str,
+        date_stop_str,
+        cloud_cover_units,
+        is_cached=cloud_cover_cached,
+    )
 
 
 @permacache(
-    "weather-agg-ee/cloud_cover/cloud_cover_segment_overall",
+    "weather-agg-ee/cloud_cover/cloud_cover_segment_overall_2",
 )
-def compute_cloud_segment_overall():
-    dates = [f"{year}-01-01" for year in range(1990, 2021)]
-    assert dates[0] == date_start_str and decrement(dates[-1]) == date_end_str
-    results = 0
-    total_weight = 0
-    for start, end in zip(dates[:-1], dates[1:]):
-        result = cloud_cover_for_segment(start, end)
-        weight = (
-            datetime.strptime(end, "%Y-%m-%d") - datetime.strptime(start, "%Y-%m-%d")
-        ).days
-        results += result * weight
-        total_weight += weight
-    return results / total_weight
+def compute_cloud_segment_overall(
+    date_start_str=date_start_str, date_stop_str=date_stop_str
+):
+    return weighted_mean(
+        cloud_cover_for_range,
+        date_start_str,
+        date_stop_str,
+        units=cloud_cover_units,
+        is_cached=cloud_cover_cached,
+    )
+
+
+def cloud_cover_for_segment_for_parallel(date_start_str, date_end_str):
+    return cloud_cover_for_range(date_start_str, date_end_str)
+
+
+def cache_jobs():
+    return [
+        job_group(
+            "cloud_cover",
+            cloud_cover_for_segment_for_parallel,
+            [
+                (start, end)
+                for start, end in cloud_cover_segments()
+                if not cloud_cover_cached(start, end)
+            ],
+            ["sunniness"],
+        )
+    ]
 
 
 if __name__ == "__main__":
@@ -3,3 +3,6 @@ year_end = 2019  # inclusive
 
 date_start_str = f"{year_start}-01-01"
 date_end_str = f"{year_end}-12-31"
+
+# exclusive end of the study period, for half-open [start, stop) date ranges
+date_stop_str = f"{year_end + 1}-01-01"
@@ -1,31 +1,109 @@
 import multiprocessing
+import os
 from datetime import datetime
 
 import ee
-import tqdm
-from permacache import permacache
+import numpy as np
+from permacache import drop_if_equal, permacache
 
-from download import download_ee_image
-from heat_index import compute_heat_index, f_to_k
-from sample import compute_date_strs
+import quantize
+from download import download_ee_image, download_stacked_images
+from heat_index import compute_heat_index, compute_heat_index_ee, f_to_k
+from instrumentation import instrumented
+from reducer import checkpoint_folder, reduce_dates, statistic
+from sample import batches, sample_date_strs, sampled_date_collection, stratum_weights
+from scheduler import job_group, run_jobs
+
+# Number of dates stacked into one multi-band image by the batched functions
+dates_per_request = 8
+
+humidity_bands = ["dewpoint_temperature_2m", "maximum_2m_air_temperature"]
+
+# encodings of the per-date grids, see `high_dewpoint_and_temp_for_date`
+humidity_encodings = {band: quantize.encodings[band] for band in humidity_bands}
+
+humidity_statistics = [
+    statistic(
+        "high_dewpoint_over_70f",
+        "fraction_above",
+        "dewpoint_temperature_2m",
+        "%",
+        threshold=f_to_k(70),
+    ),
+    statistic(
+        "high_dewpoint_over_50f",
+        "fraction_above",
+        "dewpoint_temperature_2m",
+        "%",
+        threshold=f_to_k(50),
+    ),
+    statistic("mean_high_dewpoint", "mean", "dewpoint_temperature_2m", "K"),
+    statistic("mean_heat_index", "mean", "heat_index", "K"),
+]
+
+humidity_related_units = {stat["name"]: stat["unit"] for stat in humidity_statistics}
+
+
+def fahrenheit_edges(low, high, step=5):
+    """Sketch bin edges in Kelvin, every `step`°F from `low` to `high`."""
+    return f_to_k(np.arange(low, high + step, step))
+
+
+# sketches answer other thresholds and quantiles, see `humidity_sketch`
+humidity_sketches = [
+    statistic(
+        "dewpoint_temperature_2m_sketch",
+        "histogram",
+        "dewpoint_temperature_2m",
+        "K",
+        edges=fahrenheit_edges(-40, 90),
+    ),
+    statistic(
+        "heat_index_sketch",
+        "histogram",
+        "heat_index",
+        "K",
+        edges=fahrenheit_edges(-40, 140),
+    ),
+]
+
+
+def heat_index_field(fields, out=None):
+    return compute_heat_index(
+        fields["maximum_2m_air_temperature"],
+        fields["dewpoint_temperature_2m"],
+        out=out,
+    )
+
+
+def high_dewpoint_image(date_str):
+    date = ee.Date(date_str)
+    era5_land = ee.ImageCollection("ECMWF/ERA5/HOURLY")
+    day_collection = era5_land.filter(ee.Filter.date(date, date.advance(1, "day")))
+    return day_collection.max().select(["dewpoint_temperature_2m"])
+
+
+def high_temp_image(date_str):
+    date = ee.Date(date_str)
+    era5_land = ee.ImageCollection("ECMWF/ERA5/DAILY")
+    day_collection = era5_land.filter(ee.Filter.date(date, date.advance(1, "day")))
+    return day_collection.first().select(["maximum_2m_air_temperature"])
 
 
 @permacache("weather-agg-ee/dewpoint/high_dewpoint_for_date_5", multiprocess_safe=True)
+@instrumented
 def high_dewpoint_for_date(date_str):
     start = datetime.now()
     print(f"{start} - Start {date_str}")
     ee.Initialize()
-    date = ee.Date(date_str)
-    era5_land = ee.ImageCollection("ECMWF/ERA5/HOURLY")
-
-    day_collection = era5_land.filter(ee.Filter.date(date, date.advance(1, "day")))
 
     result = download_ee_image(
-        day_collection.max(),
+        high_dewpoint_image(date_str),
         "dewpoint_temperature_2m",
         resolution=0.25,
         degree_size=45,
         pbar=False,
+        max_workers=4,
     )
     end = datetime.now()
     print(f"{end} - Finished {date_str}; took {end - start}")
@@ -33,48 +111,263 @@ def high_dewpoint_for_date(date_str):
 
 
 @permacache("weather-agg-ee/dewpoint/high_temp_for_date", multiprocess_safe=True)
+@instrumented
 def high_temp_for_date(date_str):
     start = datetime.now()
     proc_id = multiprocessing.current_process().pid
     print(f"{start} - Start {date_str} [{proc_id}]")
     ee.Initialize()
-    date = ee.Date(date_str)
-    era5_land = ee.ImageCollection("ECMWF/ERA5/DAILY")
-    day_collection = era5_land.filter(ee.Filter.date(date, date.advance(1, "day")))
     result = download_ee_image(
-        day_collection.first(),
+        high_temp_image(date_str),
         "maximum_2m_air_temperature",
         resolution=0.25,
         degree_size=45,
         pbar=False,
+        max_workers=4,
     )
     end = datetime.now()
     print(f"{end} - Finished {date_str}; took {end - start} [{proc_id}]")
     return result
 
 
+def high_dewpoint_and_temp_image(date_str):
+    return high_dewpoint_image(date_str).addBands(high_temp_image(date_str))
+
+
+@permacache(
+    "weather-agg-ee/dewpoint/high_dewpoint_and_temp_for_date",
+    key_function=dict(encodings=drop_if_equal(None)),
+    multiprocess_safe=True,
+)
+@instrumented
+def high_dewpoint_and_temp_for_date(date_str, encodings=None):
+    """Daily high dewpoint and temperature, fetched in one request per tile.
+
+    Args:
+        encodings: If given, e.g. `humidity_encodings`, the grids are encoded
+            with it, see `quantize`, and cached apart from full precision
+            ones. `reducer.reduce_dates` decodes them.
+    """
+    start = datetime.now()
+    print(f"{start} - Start {date_str}")
+    ee.Initialize()
+    result = download_ee_image(
+        high_dewpoint_and_temp_image(date_str),
+        humidity_bands,
+        resolution=0.25,
+        degree_size=45,
+        pbar=False,
+        max_workers=4,
+    )
+    end = datetime.now()
+    print(f"{end} - Finished {date_str}; took {end - start}")
+    if encodings is None:
+        return result
+    return quantize.encode_fields(result, encodings)
+
+
+@permacache(
+    "weather-agg-ee/dewpoint/high_dewpoint_and_temp_for_date",
+    key_function=dict(encodings=drop_if_equal(None)),
+    parallel=("date_str",),
+    multiprocess_safe=True,
+)
+@instrumented
+def high_dewpoint_and_temp_for_dates(date_str, encodings=None):
+    """Batched high_dewpoint_and_temp_for_date, sharing its cache entries.
+
+    `date_str` is a list of dates; only the uncached ones are downloaded, in
+    stacks of `dates_per_request` dates per image.
+    """
+    start = datetime.now()
+    print(f"{start} - Start {len(date_str)} dates from {date_str[0]}")
+    ee.Initialize()
+    result = [
+        value if encodings is None else quantize.encode_fields(value, encodings)
+        for batch in batches(date_str, dates_per_request)
+        for value in download_stacked_images(
+            [high_dewpoint_and_temp_image(d) for d in batch],
+            humidity_bands,
+            resolution=0.25,
+            degree_size=None,
+            pbar=False,
+            max_workers=4,
+        )
+    ]
+    end = datetime.now()
+    print(f"{end} - Finished {len(date_str)} dates; took {end - start}")
+    return result
+
+
+def legacy_cached(date_str):
+    """Whether a date is in the separate dewpoint and temperature caches."""
+    return all(
+        function.cache_contains(date_str)
+        for function in (high_dewpoint_for_date, high_temp_for_date)
+    )
+
+
+def humidity_cached(date_str):
+    """Whether a date is in any of the caches `humidity_fields_for_date` reads."""
+    return (
+        high_dewpoint_and_temp_for_date.cache_contains(
+            date_str, encodings=humidity_encodings
+        )
+        or high_dewpoint_and_temp_for_date.cache_contains(date_str)
+        or legacy_cached(date_str)
+    )
+
+
+def humidity_fields_for_date(date_str):
+    """Daily high dewpoint and temperature, encoded with `humidity_encodings`
+    unless cached in full precision.
+
+    Dates cached in full precision, combined or separately, before the
+    encoded cache, are read from there rather than fetched again.
+    """
+    if high_dewpoint_and_temp_for_date.cache_contains(date_str):
+        return high_dewpoint_and_temp_for_date(date_str)
+    if legacy_cached(date_str):
+        return dict(
+            dewpoint_temperature_2m=high_dewpoint_for_date(date_str),
+            maximum_2m_air_temperature=high_temp_for_date(date_str),
+        )
+    return high_dewpoint_and_temp_for_date(date_str, encodings=humidity_encodings)
+
+
+@permacache("weather-agg-ee/dewpoint/humidity_reduction", multiprocess_safe=True)
+def humidity_reduction(count=2000, tolerances=None, stratified=False):
+    """Humidity statistics and sketches, in one pass over the sampled dates.
+
+    With `tolerances`, e.g. `dict(mean_high_dewpoint=0.05)`, at most `count`
+    dates are used, stopping once the standard errors are within them; see
+    `reducer.reduce_dates`. With `stratified`, the dates are balanced across
+    calendar months and years and weighted accordingly, see `sample`.
+    """
+    date_strs = sample_date_strs(count, stratified)
+    return reduce_dates(
+        humidity_fields_for_date,
+        date_strs,
+        humidity_statistics + humidity_sketches,
+        derived=dict(heat_index=heat_index_field),
+        checkpoint_path=os.path.join(checkpoint_folder, f"dewpoint_{count}.npz"),
+        tolerances=tolerances,
+        weights=stratum_weights if stratified else None,
+        desc="Dewpoint",
+    )
+
+
 @permacache(
     "weather-agg-ee/dewpoint/aggregated_humidity_related_values_4",
     multiprocess_safe=True,
 )
 def aggregated_humidity_related_values(count=2000):
-    gt_70f = 0
-    gt_50f = 0
-    sum_dewpoint = 0
-    sum_heat_index = 0
-    for date_str in tqdm.tqdm(compute_date_strs()[:count], desc="Dewpoint"):
-        dewpoint = high_dewpoint_for_date(date_str)
-        temp = high_temp_for_date(date_str)
-        gt_70f += dewpoint > f_to_k(70)
-        gt_50f += dewpoint > f_to_k(50)
-        sum_dewpoint += dewpoint
-        sum_heat_index += compute_heat_index(temp, dewpoint)
-    return {
-        "high_dewpoint_over_70f": (gt_70f / count, "%"),
-        "high_dewpoint_over_50f": (gt_50f / count, "%"),
-        "mean_high_dewpoint": (sum_dewpoint / count, "K"),
-        "mean_heat_index": (sum_heat_index / count, "K"),
+    result = humidity_reduction(count)
+    return {stat["name"]: result[stat["name"]] for stat in humidity_statistics}
+
+
+def humidity_sketch(field, count=2000):
+    """Per-pixel histogram sketch of "dewpoint_temperature_2m" or "heat_index".
+
+    For example, the fraction of days with a dewpoint over 60°F is
+    `sketch.exceedance_fraction(humidity_sketch("dewpoint_temperature_2m"), f_to_k(60))`.
+    """
+    value, _ = humidity_reduction(count)[f"{field}_sketch"]
+    return value
+
+
+def humidity_related_image(date_str):
+    image = high_dewpoint_and_temp_image(date_str)
+    dewpoint = image.select("dewpoint_temperature_2m")
+    temp = image.select("maximum_2m_air_temperature")
+    return ee.Image(
+        [
+            dewpoint.gt(f_to_k(70)).rename("high_dewpoint_over_70f"),
+            dewpoint.gt(f_to_k(50)).rename("high_dewpoint_over_50f"),
+            dewpoint.rename("mean_high_dewpoint"),
+            compute_heat_index_ee(temp, dewpoint).rename("mean_heat_index"),
+        ]
+    )
+
+
+@instrumented
+def aggregated_humidity_related_values_server_side(count=2000):
+    """Same as aggregated_humidity_related_values, but reduced in Earth Engine.
+
+    The per-date thresholds, heat index and mean over the sampled dates are all
+    computed server-side, so only the final grids are downloaded. Cached by
+    the computation, see `download.download_ee_image_by_computation`.
+    """
+    ee.Initialize()
+    mean = sampled_date_collection(humidity_related_image, count).mean()
+    result = download_ee_image(
+        mean, list(humidity_related_units), resolution=0.25, degree_size=45, cache=True
+    )
+    return {name: (result[name], unit) for name, unit in humidity_related_units.items()}
+
+
+def check_server_side(count=20):
+    """Maximum absolute difference between the local and server-side modes."""
+    local = aggregated_humidity_related_values(count)
+    server = aggregated_humidity_related_values_server_side(count)
+    return {name: np.abs(local[name][0] - server[name][0]).max() for name in local}
+
+
+# mean absolute differences allowed between statistics from encoded and from
+# full precision per-date grids, see `check_encoding`
+encoding_tolerances = dict(
+    high_dewpoint_over_70f=1e-4,
+    high_dewpoint_over_50f=1e-4,
+    mean_high_dewpoint=0.005,
+    mean_heat_index=0.01,
+)
+
+
+def check_encoding(count=20):
+    """Mean absolute difference between the humidity statistics computed from
+    encoded and from freshly downloaded full precision grids.
+
+    Means are within half of the 0.01 K encoding step; fractions only differ
+    on dates within that of the threshold.
+
+    Raises:
+        ValueError: If a difference is beyond `encoding_tolerances`
+    """
+    ee.Initialize()
+    date_strs = sample_date_strs(count)
+    exact = {
+        date_str: download_ee_image(
+            high_dewpoint_and_temp_image(date_str),
+            humidity_bands,
+            resolution=0.25,
+            degree_size=45,
+            pbar=False,
+            max_workers=4,
+        )
+        for date_str in date_strs
+    }
+    derived = dict(heat_index=heat_index_field)
+    full = reduce_dates(
+        exact.__getitem__, date_strs, humidity_statistics, derived=derived
+    )
+    encoded = reduce_dates(
+        lambda date_str: quantize.encode_fields(exact[date_str], humidity_encodings),
+        date_strs,
+        humidity_statistics,
+        derived=derived,
+    )
+    errors = {
+        name: float(np.nanmean(np.abs(full[name][0] - encoded[name][0])))
+        for name in encoding_tolerances
+    }
+    beyond = {
+        name: error
+        for name, error in errors.items()
+        if error > encoding_tolerances[name]
     }
+    if beyond:
+        raise ValueError(f"Encoding errors beyond tolerance: {beyond}")
+    return errors
 
 
 def high_dewpoint_for_date_for_parallel(date_str):
@@ -85,10 +378,32 @@ def high_temp_for_date_for_parallel(date_str):
     return high_temp_for_date(date_str)
 
 
+def high_dewpoint_and_temp_for_date_for_parallel(date_str):
+    return high_dewpoint_and_temp_for_date(date_str)
+
+
+def high_dewpoint_and_temp_for_dates_for_parallel(date_strs):
+    high_dewpoint_and_temp_for_dates(date_strs, encodings=humidity_encodings)
+
+
+def cache_jobs(count=2000, stratified=False):
+    date_strs = [
+        date_str
+        for date_str in sample_date_strs(count, stratified)
+        if not humidity_cached(date_str)
+    ]
+    return [
+        job_group(
+            "dewpoint",
+            high_dewpoint_and_temp_for_dates_for_parallel,
+            [(batch,) for batch in batches(date_strs, dates_per_request)],
+            list(humidity_related_units),
+        )
+    ]
+
+
 def populate_caches():
-    with multiprocessing.Pool(processes=8) as pool:
-        pool.map(high_dewpoint_for_date_for_parallel, compute_date_strs()[:2000])
-        pool.map(high_temp_for_date_for_parallel, compute_date_strs()[:2000])
+    run_jobs(cache_jobs())
 
 
 if __name__ == "__main__":
@@ -1,11 +1,24 @@
+import contextlib
+import contextvars
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import ee
 import numpy as np
 import tqdm
+from permacache import permacache
+
+from instrumentation import record_request
 
 
 def download_point(point, ee_data: ee.Image, band_name: str, resolution=0.25):
     """Download temperature data for a specific point."""
     print(f"Downloading {point}...")
+    start = time.time()
 
     # Create export region for this point
     export_region = ee.Geometry.Point(point)
@@ -16,7 +29,11 @@ def download_point(point, ee_data: ee.Image, band_name: str, resolution=0.25):
     image_array = resampled_image.sampleRectangle(region=export_region, defaultValue=0)
 
     # Get the actual data - the band name should match what we set in the temperature function
-    point_temp_data = image_array.get(band_name).getInfo()
+    try:
+        point_temp_data = image_array.get(band_name).getInfo()
+    except (ee.EEException, OSError) as e:
+        record_request("point", time.time() - start, None, retries=0, error=e)
+        raise
 
     if point_temp_data is None:
         # Debug: Check what bands are available
@@ -39,11 +56,16 @@ def download_point(point, ee_data: ee.Image, band_name: str, resolution=0.25):
     print(
         f"Downloaded {point} shape: {len(point_temp_data)} x {len(point_temp_data[0])}"
     )
+    record_request("point", time.time() - start, point_temp_data, retries=0)
     return point_temp_data
 
 
-def download_quadrant(bounds, ee_data: ee.Image, band_name: str, resolution=0.25):
-    """Download temperature data for a specific quadrant."""
+def download_quadrant(bounds, ee_data: ee.Image, band_name, resolution=0.25):
+    """Download temperature data for a specific quadrant.
+
+    If `band_name` is a list of bands, they are all fetched in a single request
+    and a dictionary from band name to data is returned.
+    """
     # print(f"Downloading {bounds}...")
 
     # Create export region for this quadrant
@@ -51,11 +73,16 @@ def download_quadrant(bounds, ee_data: ee.Image, band_name: str, resolution=0.25
 
     resampled_image = ee_data.reproject(crs="EPSG:4326", scale=111_300.0 * resolution)
 
+    band_names = [band_name] if isinstance(band_name, str) else list(band_name)
+
     # Get the image as a numpy array using sampleRectangle
     image_array = resampled_image.sampleRectangle(
-        region=export_region, defaultValue=0, properties=[band_name]
+        region=export_region, defaultValue=0, properties=band_names
     )
 
+    if not isinstance(band_name, str):
+        return image_array.toDictionary(band_names).getInfo()
+
     # Get the actual data - the band name should match what we set in the temperature function
     quadrant_temp_data = image_array.get(band_name).getInfo()
 
@@ -83,104 +110,348 @@ def download_quadrant(bounds, ee_data: ee.Image, band_name: str, resolution=0.25
     return quadrant_temp_data
 
 
-def merge_quadrants(quadrant_data):
-    """Merge 4 quadrant arrays into a single global array."""
-    print("Merging quadrants...")
+# sampleRectangle pixel budget per request; 45° tiles at 0.25° are known to work
+max_tile_pixels = 180 * 180
 
-    # Quadrant order: NW, NE, SW, SE
-    nw_data, ne_data, sw_data, se_data = quadrant_data
+# Earth Engine's sampleRectangle limit per request, in pixels summed over bands
+max_request_pixels = 262144
 
-    # Get dimensions
-    nw_height = len(nw_data)
-    nw_width = len(nw_data[0])
-    sw_height = len(sw_data)
 
-    # Calculate total dimensions
-    total_height = nw_height + sw_height
-    total_width = nw_width + len(ne_data[0])
+def band_pixel_budget(num_bands):
+    """Pixels per band in one tile, for a request of `num_bands` bands.
 
-    print(f"Creating merged array: {total_height} x {total_width}")
+    A single band keeps the `max_tile_pixels` known to work. Several bands
+    share the per-request limit, rather than dividing the single band budget.
+    """
+    return min(max_tile_pixels, max_request_pixels // num_bands)
 
-    # Create merged array
-    merged_data = []
 
-    # Add northern row (NW + NE)
-    for i in range(nw_height):
-        row = nw_data[i] + ne_data[i]
-        merged_data.append(row)
+# limits the Earth Engine requests in flight across threads, and across worker
+# processes when shared by `scheduler.run_jobs`; None for no limit
+request_slots = None
 
-    # Add southern row (SW + SE)
-    for i in range(sw_height):
-        row = sw_data[i] + se_data[i]
-        merged_data.append(row)
 
-    return merged_data
+def set_request_slots(slots):
+    """Share a semaphore limiting the requests in flight, e.g. in a pool worker."""
+    global request_slots
+    request_slots = slots
 
 
-def merge_quadrants_8(quadrant_data):
-    """Merge 8 quadrant arrays into a single global array."""
-    print("Merging 8 quadrants...")
+def is_too_large_error(error):
+    """Whether an Earth Engine error means the requested region was too large."""
+    message = str(error).lower()
+    return "too many pixels" in message or "payload" in message
 
-    # Quadrant order: NW, N, NE, NE2, SW, S, SE, SE2
-    (
-        nw_data,
-        n_data,
-        ne_data,
-        ne2_data,
-        sw_data,
-        s_data,
-        se_data,
-        se2_data,
-    ) = quadrant_data
 
-    # Get dimensions
-    nw_height = len(nw_data)
-    nw_width = len(nw_data[0])
-    sw_height = len(sw_data)
+def is_too_expensive_error(error):
+    """Whether an Earth Engine error means the computation was too expensive, so
+    that reducing a shorter time range might succeed."""
+    message = str(error).lower()
+    return isinstance(error, ee.EEException) and (
+        "timed out" in message
+        or "memory limit" in message
+        or "too many concurrent aggregations" in message
+    )
+
+
+def download_quadrant_with_retry(
+    bounds, ee_data: ee.Image, band_name, resolution=0.25, *, retries=3
+):
+    """Download a quadrant, retrying with exponential backoff on failure.
+
+    Errors caused by the region being too large, or the computation being too
+    expensive (see `is_too_expensive_error`), are raised immediately: retrying
+    the same request would repeat the same work, while the caller can split
+    the region or the date range instead.
+
+    Each call is recorded as one request by `instrumentation.record_request`.
+
+    Args:
+        retries: Number of additional attempts after the first failure
+    """
+    start = time.time()
+    for attempt in range(retries + 1):
+        try:
+            # the slot is not held while backing off
+            with request_slots or contextlib.nullcontext():
+                data = download_quadrant(bounds, ee_data, band_name, resolution)
+        except (ee.EEException, OSError) as e:
+            if attempt == retries or is_too_large_error(e) or is_too_expensive_error(e):
+                record_request(
+                    "tile", time.time() - start, None, retries=attempt, error=e
+                )
+                raise
+            delay = 2**attempt
+            print(f"Tile {bounds} failed ({e}); retrying in {delay}s")
+            time.sleep(delay)
+        else:
+            record_request("tile", time.time() - start, data, retries=attempt)
+            return data
+
+
+tile_journal_folder = "tile_journal"
+
 
-    # Calculate total dimensions
-    total_height = nw_height + sw_height
-    total_width = nw_width + len(n_data[0]) + len(ne_data[0]) + len(ne2_data[0])
+def computation_hash(ee_data):
+    """Hash of the serialized Earth Engine computation graph of an image."""
+    return hashlib.sha256(ee_data.serialize().encode("utf-8")).hexdigest()
 
-    print(f"Creating merged array: {total_height} x {total_width}")
 
-    # Create merged array
-    merged_data = []
+def journal_folder(ee_data, band_names, resolution):
+    """Folder of the tile journal of an image download.
+
+    It is keyed by the computation, bands and resolution, so tiles of other
+    downloads are never reused.
+    """
+    spec = json.dumps([computation_hash(ee_data), band_names, resolution])
+    key = hashlib.sha256(spec.encode("utf-8")).hexdigest()
+    return os.path.join(tile_journal_folder, key)
+
+
+def remove_journal(ee_data, band_name, resolution=0.25):
+    """Remove the tile journal of an image download, if there is one.
+
+    E.g. when a download failed part way and its range was split instead.
+    """
+    band_names = [band_name] if isinstance(band_name, str) else list(band_name)
+    journal = journal_folder(ee_data, band_names, resolution)
+    if os.path.exists(journal):
+        shutil.rmtree(journal)
+
+
+def journal_tile_path(journal, bounds):
+    return os.path.join(journal, "_".join(repr(float(b)) for b in bounds) + ".npz")
 
-    # Add northern row (NW + N + NE + NE2)
-    for i in range(nw_height):
-        row = nw_data[i] + n_data[i] + ne_data[i] + ne2_data[i]
-        merged_data.append(row)
 
-    # Add southern row (SW + S + SE + SE2)
-    for i in range(sw_height):
-        row = sw_data[i] + s_data[i] + se_data[i] + se2_data[i]
-        merged_data.append(row)
+def save_journal_tile(journal, bounds, band_name, data):
+    os.makedirs(journal, exist_ok=True)
+    if isinstance(band_name, str):
+        data = {band_name: data}
+    path = journal_tile_path(journal, bounds)
+    temporary = f"{path}.tmp.npz"
+    np.savez(temporary, **{name: np.asarray(value) for name, value in data.items()})
+    os.replace(temporary, path)
 
-    return merged_data
+
+def load_journal_tile(journal, bounds, band_name):
+    """Journaled data of a tile, as `download_quadrant` returns it, or None."""
+    path = journal_tile_path(journal, bounds)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if isinstance(band_name, str):
+            return data[band_name]
+        return {name: data[name] for name in band_name}
+
+
+def split_bounds(bounds, resolution):
+    """Split tile bounds into (up to) four quadrants along pixel boundaries.
+
+    Returns:
+        list: List of (min_lon, min_lat, max_lon, max_lat) tuples
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    row_slice, col_slice = tile_slices(bounds, resolution)
+    rows = row_slice.stop - row_slice.start
+    cols = col_slice.stop - col_slice.start
+    if rows == 1 and cols == 1:
+        raise ValueError(f"Cannot split single pixel tile {bounds}")
+    mid_lon = min_lon + (cols // 2) * resolution
+    mid_lat = min_lat + (rows // 2) * resolution
+    lon_ranges = [(min_lon, max_lon)]
+    if cols > 1:
+        lon_ranges = [(min_lon, mid_lon - resolution), (mid_lon, max_lon)]
+    lat_ranges = [(min_lat, max_lat)]
+    if rows > 1:
+        lat_ranges = [(min_lat, mid_lat - resolution), (mid_lat, max_lat)]
+    return [
+        (lon_start, lat_start, lon_end, lat_end)
+        for lat_start, lat_end in lat_ranges
+        for lon_start, lon_end in lon_ranges
+    ]
+
+
+def download_region(
+    bounds, ee_data: ee.Image, band_name, resolution=0.25, *, retries=3, journal=None
+):
+    """Download a tile, splitting it into quadrants if it is too large.
+
+    Args:
+        journal: If given, the folder of a tile journal. Tiles found there are
+            not downloaded again, and downloaded tiles are saved there.
+
+    Returns:
+        list: (bounds, tile data) pairs covering the requested tile
+    """
+    if journal is not None:
+        data = load_journal_tile(journal, bounds, band_name)
+        if data is not None:
+            return [(bounds, data)]
+    try:
+        data = download_quadrant_with_retry(
+            bounds, ee_data, band_name, resolution, retries=retries
+        )
+    except ee.EEException as e:
+        if not is_too_large_error(e):
+            raise
+        print(f"Tile {bounds} too large ({e}); splitting")
+    else:
+        if journal is not None:
+            save_journal_tile(journal, bounds, band_name, data)
+        return [(bounds, data)]
+    return [
+        piece
+        for sub_bounds in split_bounds(bounds, resolution)
+        for piece in download_region(
+            sub_bounds, ee_data, band_name, resolution, retries=retries, journal=journal
+        )
+    ]
+
+
+def iter_downloaded_tiles(
+    tiles,
+    ee_data: ee.Image,
+    band_name,
+    resolution,
+    *,
+    max_workers,
+    retries,
+    pbar,
+    journal=None,
+):
+    """Download the given tiles, with at most `max_workers` requests in flight.
+
+    Yields:
+        tuple: (bounds, tile data) pairs, in completion order. Tiles that had
+            to be split yield one pair per piece.
+    """
+    if max_workers == 1:
+        for bounds in tqdm.tqdm(tiles) if pbar else tiles:
+            yield from download_region(
+                bounds, ee_data, band_name, resolution, retries=retries, journal=journal
+            )
+        return
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # copy the context, so requests are attributed to the calling statistic
+        futures = [
+            executor.submit(
+                contextvars.copy_context().run,
+                download_region,
+                bounds,
+                ee_data,
+                band_name,
+                resolution,
+                retries=retries,
+                journal=journal,
+            )
+            for bounds in tiles
+        ]
+        completed = as_completed(futures)
+        for future in tqdm.tqdm(completed, total=len(tiles)) if pbar else completed:
+            yield from future.result()
+
+
+def adaptive_degree_size(resolution, max_pixels=max_tile_pixels):
+    """Largest tile size (in degrees) within the pixel budget at `resolution`.
+
+    Only sizes that evenly divide the globe and a whole number of pixels are
+    considered.
+    """
+    for degree_size in sorted((d for d in range(1, 181) if 180 % d == 0), reverse=True):
+        pixels_per_side = degree_size / resolution
+        if abs(pixels_per_side - round(pixels_per_side)) > 1e-9:
+            continue
+        if pixels_per_side**2 <= max_pixels:
+            return degree_size
+    raise ValueError(f"No tile size fits {max_pixels} pixels at {resolution}°")
+
+
+def global_shape(resolution):
+    """Shape of the global (lat, lon) grid at the given resolution."""
+    return round(180 / resolution), round(360 / resolution)
+
+
+def tile_slices(bounds, resolution):
+    """Location of a tile from `generate_tiles` within the global grid.
+
+    Row 0 of the global grid is the northernmost row, matching the row order
+    of the data returned by `sampleRectangle`, so tiles are flipped into place
+    by their row offset alone.
+
+    Returns:
+        tuple: (row slice, column slice) into the global array
+    """
+    min_lon, min_lat, max_lon, max_lat = bounds
+    row_start = round((90 - max_lat) / resolution) - 1
+    row_end = round((90 - min_lat) / resolution)
+    col_start = round((min_lon + 180) / resolution)
+    col_end = round((max_lon + 180) / resolution) + 1
+    return slice(row_start, row_end), slice(col_start, col_end)
+
+
+def merge_tile_grid(tile_rows, dtype=np.float32):
+    """Merge a grid of tiles into a single preallocated array.
+
+    Args:
+        tile_rows: List of rows of tiles, northernmost row first
+        dtype: dtype of the merged array
+
+    Returns:
+        np.ndarray: Merged array
+    """
+    heights = [len(row[0]) for row in tile_rows]
+    widths = [len(tile[0]) for tile in tile_rows[0]]
+    merged = np.empty((sum(heights), sum(widths)), dtype=dtype)
+    row_start = 0
+    for height, row in zip(heights, tile_rows):
+        col_start = 0
+        for width, tile in zip(widths, row):
+            merged[row_start : row_start + height, col_start : col_start + width] = tile
+            col_start += width
+        row_start += height
+    return merged
+
+
+def merge_quadrants(quadrant_data):
+    """Merge 4 quadrant arrays into a single global array."""
+    print("Merging quadrants...")
+
+    # Quadrant order: NW, NE, SW, SE
+    nw_data, ne_data, sw_data, se_data = quadrant_data
+
+    return merge_tile_grid([[nw_data, ne_data], [sw_data, se_data]])
+
+
+def merge_quadrants_8(quadrant_data):
+    """Merge 8 quadrant arrays into a single global array."""
+    print("Merging 8 quadrants...")
+
+    # Quadrant order: NW, N, NE, NE2, SW, S, SE, SE2
+    return merge_tile_grid([quadrant_data[:4], quadrant_data[4:]])
 
 
 def merge_tiles(tile_data, degree_size):
     """Merge tile arrays into a single global array.
 
     Args:
-        tile_data: List of tile data arrays
+        tile_data: List of tile data arrays, in the order of `generate_tiles`
         degree_size: Size of each tile in degrees
 
     Returns:
-        list: Merged global array
+        np.ndarray: Merged global array
     """
     num_rows = 180 // degree_size
     num_cols = 360 // degree_size
 
     assert len(tile_data) == num_rows * num_cols
 
+    # generate_tiles goes south to north, the merged array north to south
     rows = [
-        np.hstack(tile_data[row_idx * num_cols : (row_idx + 1) * num_cols])
+        tile_data[row_idx * num_cols : (row_idx + 1) * num_cols]
         for row_idx in range(num_rows)
     ]
 
-    return np.vstack(rows[::-1])
+    return merge_tile_grid(rows[::-1])
 
 
 def generate_tiles(degree_size=45, *, resolution):
@@ -212,31 +483,185 @@ def generate_tiles(degree_size=45, *, resolution):
 
 def download_ee_image(
     ee_data: ee.Image,
-    band_name: str = "mean_daily_max_temperature_celsius",
+    band_name="mean_daily_max_temperature_celsius",
     resolution=0.25,
     degree_size=45,
     pbar=True,
+    max_workers=1,
+    retries=3,
+    dtype=np.float32,
+    journal=False,
+    cache=False,
 ):
     """Download mean daily maximum temperature data in tiles and merge.
 
     Args:
         ee_data: Earth Engine image
         filename: Output filename
-        band_name: Name of the band to extract
+        band_name: Name of the band to extract, or a list of band names to fetch
+            together in one request per tile
         resolution: Resolution multiplier (default 0.25)
-        degree_size: Size of each tile in degrees (default 45°)
+        degree_size: Size of each tile in degrees (default 45°). If None, the
+            largest size within `band_pixel_budget` at `resolution` is used.
+            Tiles that turn out to be too large are split into quadrants.
+        max_workers: Maximum number of tile requests in flight (default 1, serial)
+        retries: Number of retries per tile before giving up (default 3)
+        dtype: dtype of the returned global array (default float32)
+        journal: Whether to save each tile under `tile_journal_folder` as it
+            completes, so that a download that failed part way only fetches
+            the missing tiles when restarted. The journal is removed once the
+            image is complete.
+        cache: Whether to cache the result by its computation, see
+            `download_ee_image_by_computation`
+
+    Returns:
+        np.ndarray: Global array, or a dictionary from band name to global array
+            if `band_name` is a list
     """
+    if cache:
+        return download_ee_image_by_computation(
+            ee_data,
+            band_name,
+            resolution,
+            dtype,
+            degree_size=degree_size,
+            pbar=pbar,
+            max_workers=max_workers,
+            retries=retries,
+            journal=journal,
+        )
+
+    band_names = [band_name] if isinstance(band_name, str) else list(band_name)
+
+    if degree_size is None:
+        degree_size = adaptive_degree_size(
+            resolution, band_pixel_budget(len(band_names))
+        )
 
     # Generate tiles based on degree size
     tiles = generate_tiles(degree_size, resolution=resolution)
 
-    # Download each tile
-    tile_data = []
-    for bounds in tqdm.tqdm(tiles) if pbar else tiles:
-        tile_temp_data = download_quadrant(bounds, ee_data, band_name, resolution)
-        tile_data.append(tile_temp_data)
+    journal_path = journal_folder(ee_data, band_names, resolution) if journal else None
+
+    # Download each tile straight into its slice of the global array
+    merged_data = np.empty((len(band_names), *global_shape(resolution)), dtype=dtype)
+    for bounds, tile_temp_data in iter_downloaded_tiles(
+        tiles,
+        ee_data,
+        band_name,
+        resolution,
+        max_workers=max_workers,
+        retries=retries,
+        pbar=pbar,
+        journal=journal_path,
+    ):
+        if isinstance(band_name, str):
+            tile_temp_data = {band_name: tile_temp_data}
+        rows, cols = tile_slices(bounds, resolution)
+        for band_idx, name in enumerate(band_names):
+            merged_data[band_idx, rows, cols] = tile_temp_data[name]
+
+    if journal_path is not None and os.path.exists(journal_path):
+        shutil.rmtree(journal_path)
+
+    if isinstance(band_name, str):
+        return merged_data[0]
+    return dict(zip(band_names, merged_data))
+
+
+def ignored(value):
+    return None
+
+
+@permacache(
+    "weather-agg-ee/download/download_ee_image_by_computation_2",
+    key_function=dict(
+        ee_data=computation_hash,
+        dtype=lambda dtype: np.dtype(dtype).str,
+        degree_size=ignored,
+        pbar=ignored,
+        max_workers=ignored,
+        retries=ignored,
+        journal=ignored,
+    ),
+    multiprocess_safe=True,
+)
+def download_ee_image_by_computation(
+    ee_data,
+    band_name,
+    resolution,
+    dtype,
+    *,
+    degree_size,
+    pbar,
+    max_workers,
+    retries,
+    journal,
+):
+    """download_ee_image, cached by the computation rather than by its caller.
+
+    The key is the hash of the serialized computation graph, with the bands,
+    resolution and dtype of the global grid, so identical images requested
+    from different modules are downloaded once, and editing an expression
+    changes the key of exactly the images that use it. How the image is
+    fetched (tile size, workers, retries) does not change the result, so it is
+    not part of the key.
+    """
+    return download_ee_image(
+        ee_data,
+        band_name,
+        resolution=resolution,
+        degree_size=degree_size,
+        pbar=pbar,
+        max_workers=max_workers,
+        retries=retries,
+        dtype=dtype,
+        journal=journal,
+    )
+
+
+def is_image_cached(ee_data, band_name, resolution=0.25, dtype=np.float32):
+    """Whether `download_ee_image(..., cache=True)` would find the image cached."""
+    return download_ee_image_by_computation.cache_contains(
+        ee_data,
+        band_name,
+        resolution,
+        dtype,
+        degree_size=None,
+        pbar=False,
+        max_workers=1,
+        retries=0,
+        journal=False,
+    )
+
+
+def download_stacked_images(images, band_name, **kwargs):
+    """Download several images with the same bands as one multi-band image.
+
+    The bands of the i-th image are renamed to `{i}_{band}` and concatenated
+    server-side, so all images are fetched with one request per tile.
 
-    # Merge all tiles
-    merged_data = merge_tiles(tile_data, degree_size)
+    Args:
+        images: List of Earth Engine images
+        band_name: Name of the band to extract, or a list of band names
+        **kwargs: Passed to `download_ee_image`
 
-    return merged_data
+    Returns:
+        list: One result per image, as `download_ee_image` would return it
+    """
+    band_names = [band_name] if isinstance(band_name, str) else list(band_name)
+    stacked_names = [
+        [f"{idx}_{name}" for name in band_names] for idx in range(len(images))
+    ]
+    stacked = ee.Image(
+        [image.select(band_names, names) for image, names in zip(images, stacked_names)]
+    )
+    result = download_ee_image(
+        stacked, [name for names in stacked_names for name in names], **kwargs
+    )
+    if isinstance(band_name, str):
+        return [result[names[0]] for names in stacked_names]
+    return [
+        {name: result[stacked_name] for name, stacked_name in zip(band_names, names)}
+        for names in stacked_names
+    ]
@@ -0,0 +1,676 @@
+"""Offline stand-in for the subset of the Earth Engine API used by this project.
+
+Images are evaluated lazily, and only over the region that is sampled, from
+synthetic but deterministic ERA5-like data. Use `install` to swap it in for the
+real `ee` module, e.g. to run or benchmark the pipeline without credentials:
+
+    import fake_ee
+    fake_ee.install(latency=0.2, failure_rate=0.01)
+
+    from dewpoint import high_dewpoint_and_temp_for_date
+"""
+
+import re
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+
+config = dict(
+    # seconds slept on every getInfo call
+    latency=0.0,
+    # probability that a getInfo call fails with a transient EEException
+    failure_rate=0.0,
+    seed=0,
+    # sampleRectangle limit, in pixels summed over bands
+    max_pixels=262144,
+    # spacing of the images in ECMWF/ERA5/HOURLY, to keep long reductions cheap
+    hours_step=6,
+    # largest number of images one reduction may have, like the server-side
+    # memory limit; None for no limit
+    max_reduce_images=None,
+)
+
+_rng = np.random.RandomState(0)
+_rng_lock = threading.Lock()
+
+
+class EEException(Exception):
+    pass
+
+
+def configure(**kwargs):
+    """Update `config`, e.g. `configure(latency=0.5, failure_rate=0.1)`."""
+    global _rng
+    unknown = set(kwargs) - set(config)
+    if unknown:
+        raise ValueError(f"Unknown options {sorted(unknown)}")
+    config.update(kwargs)
+    with _rng_lock:
+        _rng = np.random.RandomState(config["seed"])
+
+
+def install(disable_cache=True, **kwargs):
+    """Use this module in place of `ee`, including in already imported modules.
+
+    Args:
+        disable_cache: Turn off permacache, so synthetic results are never
+            written to (or read from) the real caches
+        **kwargs: Passed to `configure`
+    """
+    configure(**kwargs)
+    real_ee = sys.modules.get("ee")
+    sys.modules["ee"] = sys.modules[__name__]
+    for module in list(sys.modules.values()):
+        if real_ee is not None and getattr(module, "ee", None) is real_ee:
+            module.ee = sys.modules[__name__]
+    if disable_cache:
+        from permacache import no_cache_global
+
+        no_cache_global.no_cache = True
+
+
+def Initialize(*args, **kwargs):
+    pass
+
+
+def _request():
+    """Simulate the latency and transient failures of one server round trip."""
+    if config["latency"]:
+        time.sleep(config["latency"])
+    with _rng_lock:
+        failed = _rng.rand() < config["failure_rate"]
+    if failed:
+        raise EEException("Computation timed out.")
+
+
+class Date:
+    def __init__(self, date):
+        if isinstance(date, Date):
+            date = date.value
+        if isinstance(date, str):
+            date = datetime.strptime(date[:10], "%Y-%m-%d")
+        self.value = date
+
+    def advance(self, delta, unit):
+        return Date(self.value + timedelta(**{unit + "s": delta}))
+
+    def __repr__(self):
+        return f"Date({self.value.isoformat()})"
+
+
+class Filter:
+    def __init__(self, predicate, description, date_range=None):
+        self.predicate = predicate
+        self.description = description
+        self.date_range = date_range
+
+    @staticmethod
+    def date(start, end):
+        start, end = Date(start), Date(end)
+        return Filter(
+            lambda when: start.value <= when < end.value,
+            f"date({start}, {end})",
+            date_range=(start.value, end.value),
+        )
+
+    @staticmethod
+    def calendarRange(start, end=None, field="day_of_year"):
+        end = start if end is None else end
+        getter = {
+            "day_of_year": lambda when: when.timetuple().tm_yday,
+            "month": lambda when: when.month,
+            "year": lambda when: when.year,
+        }[field]
+
+        def predicate(when):
+            value = getter(when)
+            if start <= end:
+                return start <= value <= end
+            return value >= start or value <= end
+
+        return Filter(predicate, f"calendarRange({start}, {end}, {field})")
+
+
+class Geometry:
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+    @staticmethod
+    def Rectangle(bounds):
+        return Geometry(tuple(bounds))
+
+    @staticmethod
+    def Point(point):
+        lon, lat = point
+        return Geometry((lon, lat, lon, lat))
+
+
+class ComputedValue:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def getInfo(self):
+        _request()
+        return self.compute()
+
+
+class Feature:
+    def __init__(self, compute_bands):
+        self.compute_bands = compute_bands
+
+    def get(self, band_name):
+        return ComputedValue(
+            lambda: _to_info(self.compute_bands([band_name])).get(band_name)
+        )
+
+    def toDictionary(self, band_names):
+        return ComputedValue(lambda: _to_info(self.compute_bands(list(band_names))))
+
+    def getInfo(self):
+        _request()
+        return {"type": "Feature", "properties": _to_info(self.compute_bands(None))}
+
+
+def _to_info(bands):
+    return {name: values.tolist() for name, values in bands.items()}
+
+
+class Image:
+    """A lazily evaluated image.
+
+    `evaluate(lats, lons, memo)` returns a dict from band name to an array of
+    shape (len(lats), len(lons)); `memo` caches sub-images within one request.
+    """
+
+    def __init__(self, args=None, *, band_names=None, evaluate=None, description=None):
+        if band_names is None:
+            if isinstance(args, Image):
+                band_names, evaluate = args.band_names, args.evaluate
+                description = args.description
+            elif isinstance(args, (list, tuple)):
+                cat = _cat([Image(x) for x in args])
+                band_names, evaluate = cat.band_names, cat.evaluate
+                description = cat.description
+            else:
+                value = float(args)
+                band_names = ["constant"]
+                evaluate = lambda lats, lons, memo: {
+                    "constant": np.full((len(lats), len(lons)), value)
+                }
+                description = f"constant({value!r})"
+        self.band_names = list(band_names)
+        self.evaluate = evaluate
+        self.description = description
+        self.scale = None
+
+    def _derive(self, band_names, compute, description):
+        """Image computed from the bands of this one by `compute(bands)`."""
+
+        def evaluate(lats, lons, memo):
+            return compute(self._evaluate(lats, lons, memo))
+
+        return Image(band_names=band_names, evaluate=evaluate, description=description)
+
+    def _evaluate(self, lats, lons, memo):
+        if id(self) not in memo:
+            memo[id(self)] = (self, self.evaluate(lats, lons, memo))
+        return memo[id(self)][1]
+
+    def serialize(self):
+        return self.description
+
+    def select(self, band_names, new_names=None):
+        if isinstance(band_names, str):
+            band_names = [band_names]
+        missing = set(band_names) - set(self.band_names)
+        if missing:
+            raise EEException(f"Image has no bands {sorted(missing)}")
+        new_names = band_names if new_names is None else list(new_names)
+        return self._derive(
+            new_names,
+            lambda bands: {new: bands[old] for old, new in zip(band_names, new_names)},
+            f"select({self.description}, {band_names}, {new_names})",
+        )
+
+    def rename(self, *names):
+        if len(names) == 1 and not isinstance(names[0], str):
+            names = names[0]
+        return self.select(self.band_names, names)
+
+    def addBands(self, other):
+        return _cat([self, other])
+
+    def gt(self, value):
+        return self._derive(
+            self.band_names,
+            lambda bands: {k: (v > value).astype(np.float64) for k, v in bands.items()},
+            f"gt({self.description}, {value!r})",
+        )
+
+    def clamp(self, low, high):
+        return self._derive(
+            self.band_names,
+            lambda bands: {k: np.clip(v, low, high) for k, v in bands.items()},
+            f"clamp({self.description}, {low!r}, {high!r})",
+        )
+
+    def expression(self, expression, variables=None):
+        variables = dict(variables or {})
+        output, evaluate_expression = _parse_expression(expression)
+        images = {k: v for k, v in variables.items() if isinstance(v, Image)}
+        constants = {k: v for k, v in variables.items() if not isinstance(v, Image)}
+
+        def evaluate(lats, lons, memo):
+            env = dict(constants)
+            for name, image in images.items():
+                env[name] = image._evaluate(lats, lons, memo)[image.band_names[0]]
+            result = evaluate_expression(env)
+            return {output: np.broadcast_to(result, (len(lats), len(lons)))}
+
+        description = "expression({!r}, {})".format(
+            expression,
+            {k: getattr(v, "description", v) for k, v in sorted(variables.items())},
+        )
+        return Image(band_names=[output], evaluate=evaluate, description=description)
+
+    def reproject(self, crs, scale):
+        result = Image(self)
+        result.description = f"reproject({self.description}, {crs!r}, {scale!r})"
+        result.scale = scale
+        return result
+
+    def sampleRectangle(self, region, defaultValue=0, properties=None):
+        resolution = (self.scale or 111_300.0 * 0.25) / 111_300.0
+        min_lon, min_lat, max_lon, max_lat = region.bounds
+        rows = int(round((max_lat - min_lat) / resolution)) + 1
+        cols = int(round((max_lon - min_lon) / resolution)) + 1
+        lats = max_lat - resolution * np.arange(rows)
+        lons = min_lon + resolution * np.arange(cols)
+
+        def compute_bands(band_names):
+            band_names = self.band_names if band_names is None else band_names
+            if rows * cols * len(band_names) > config["max_pixels"]:
+                raise EEException(
+                    f"Too many pixels in sample; must be <= {config['max_pixels']}."
+                    f" Got {rows * cols * len(band_names)}."
+                )
+            bands = self._evaluate(lats, lons, {})
+            return {name: bands[name] for name in band_names}
+
+        return Feature(compute_bands)
+
+
+def _cat(images):
+    band_names = [name for image in images for name in image.band_names]
+
+    def evaluate(lats, lons, memo):
+        result = {}
+        for image in images:
+            result.update(image._evaluate(lats, lons, memo))
+        return result
+
+    description = "cat({})".format(", ".join(image.description for image in images))
+    return Image(band_names=band_names, evaluate=evaluate, description=description)
+
+
+class ImageCollection:
+    def __init__(self, args, *, entries=None, band_names=None, description=None):
+        """A collection of (timestamp, image) entries.
+
+        Either the name of one of the synthetic datasets or a list of images.
+        `entries` may be a function, so that entries are only generated when
+        the collection is evaluated.
+        """
+        self.dataset = None
+        if entries is None:
+            if isinstance(args, str):
+                self.dataset = _Dataset(args)
+                entries = self.dataset.entries
+                band_names = self.dataset.band_names
+                description = f"ImageCollection({args!r})"
+            else:
+                images = [Image(x) for x in args]
+                entries = [(None, image) for image in images]
+                band_names = images[0].band_names if images else []
+                description = "ImageCollection([{}])".format(
+                    ", ".join(image.description for image in images)
+                )
+        self.entries = entries
+        self.band_names = band_names
+        self.description = description
+
+    def serialize(self):
+        return self.description
+
+    def filter(self, ee_filter):
+        description = f"filter({self.description}, {ee_filter.description})"
+        if self.dataset is not None and ee_filter.date_range is not None:
+            # only generate the images within the date range
+            result = ImageCollection(
+                None,
+                entries=lambda: self.dataset.entries(*ee_filter.date_range),
+                band_names=self.band_names,
+                description=description,
+            )
+            result.dataset = self.dataset
+            return result
+        return ImageCollection(
+            None,
+            entries=lambda: [
+                (when, image)
+                for when, image in self._entries()
+                if ee_filter.predicate(when)
+            ],
+            band_names=self.band_names,
+            description=description,
+        )
+
+    def map(self, function):
+        placeholder = Image(
+            band_names=self.band_names, evaluate=None, description="<element>"
+        )
+        mapped = function(placeholder)
+        return ImageCollection(
+            None,
+            entries=lambda: [
+                (when, function(image)) for when, image in self._entries()
+            ],
+            band_names=mapped.band_names,
+            description=f"map({self.description}, {mapped.description})",
+        )
+
+    def _entries(self):
+        return self.entries() if callable(self.entries) else self.entries
+
+    def _reduce(self, name, initial, step, finish):
+        def evaluate(lats, lons, memo):
+            entries = self._entries()
+            limit = config["max_reduce_images"]
+            if limit is not None and len(entries) > limit:
+                raise EEException("User memory limit exceeded.")
+            if not entries:
+                return {
+                    band: np.zeros((len(lats), len(lons))) for band in self.band_names
+                }
+            state = None
+            for _, image in entries:
+                # per-image sub-results are not shared between images
+                bands = image.evaluate(lats, lons, {})
+                if state is None:
+                    state = {k: initial(v) for k, v in bands.items()}
+                else:
+                    state = {k: step(state[k], bands[k]) for k in state}
+            return {k: finish(v, len(entries)) for k, v in state.items()}
+
+        return Image(
+            band_names=self.band_names,
+            evaluate=evaluate,
+            description=f"{name}({self.description})",
+        )
+
+    def mean(self):
+        return self._reduce(
+            "mean",
+            lambda v: v.astype(np.float64),
+            lambda acc, v: acc + v,
+            lambda acc, n: acc / n,
+        )
+
+    def sum(self):
+        return self._reduce(
+            "sum",
+            lambda v: v.astype(np.float64),
+            lambda acc, v: acc + v,
+            lambda acc, n: acc,
+        )
+
+    def max(self):
+        return self._reduce("max", np.array, np.maximum, lambda acc, n: acc)
+
+    def first(self):
+        def evaluate(lats, lons, memo):
+            entries = self._entries()
+            if not entries:
+                raise EEException("Collection is empty")
+            return entries[0][1].evaluate(lats, lons, memo)
+
+        return Image(
+            band_names=self.band_names,
+            evaluate=evaluate,
+            description=f"first({self.description})",
+        )
+
+
+def _weather(date, lats, lons):
+    """Smooth deterministic day-to-day variation in [-1, 1], one field per date."""
+    seed = zlib.crc32(date.strftime("%Y-%m-%d").encode())
+    rng = np.random.RandomState(seed)
+    lat_r = np.deg2rad(lats)[:, None]
+    lon_r = np.deg2rad(lons)[None, :]
+    result = 0
+    for _ in range(4):
+        k_lat, k_lon = rng.randint(1, 6, size=2)
+        phase = rng.rand() * 2 * np.pi
+        result = result + np.sin(k_lat * lat_r + k_lon * lon_r + phase) / 4
+    return result
+
+
+def _synthetic_bands(when, lats, lons, hourly):
+    lat_r = np.deg2rad(lats)[:, None]
+    lon_r = np.deg2rad(lons)[None, :]
+    doy = when.timetuple().tm_yday
+    hour = when.hour + 12 * (not hourly)
+    season = np.cos(2 * np.pi * (doy - 200) / 365.25) * np.sin(lat_r)
+    weather = _weather(when, lats, lons)
+    climate = 300 - 45 * np.sin(lat_r) ** 2 + 15 * season
+    dryness = 0.5 + 0.5 * np.sin(3 * lon_r) * np.cos(lat_r)
+    # hour angle of the sun, 0 at local noon
+    hour_angle = 2 * np.pi * (hour / 24 + np.rad2deg(lon_r) / 360) - np.pi
+    declination = np.deg2rad(23.44) * np.sin(2 * np.pi * (doy - 81) / 365.25)
+    cos_zenith = np.sin(lat_r) * np.sin(declination) + np.cos(lat_r) * np.cos(
+        declination
+    ) * np.cos(hour_angle)
+    if hourly:
+        temp = climate + 4 * np.cos(hour_angle) + 5 * weather
+        dewpoint = temp - 3 - 10 * dryness - 2 * np.cos(hour_angle)
+        precipitation = np.maximum(weather - 0.4, 0) * 0.003
+        precipitation_type = np.where(
+            precipitation > 0, np.where(temp > 275, 1, np.where(temp < 271, 5, 7)), 0
+        )
+        return {
+            "temperature_2m": temp,
+            "dewpoint_temperature_2m": dewpoint,
+            "u_component_of_wind_10m": 6 * np.sin(2 * lat_r) + 4 * weather,
+            "v_component_of_wind_10m": 3 * np.cos(3 * lon_r) * np.cos(lat_r)
+            - 3 * weather,
+            "total_cloud_cover": np.clip(0.5 + weather, 0, 1),
+            "mean_surface_direct_short_wave_radiation_flux_clear_sky": 900
+            * np.maximum(cos_zenith, 0),
+            "total_precipitation": precipitation,
+            "precipitation_type": precipitation_type.astype(np.float64),
+        }
+    mean = climate + 5 * weather
+    return {
+        "mean_2m_air_temperature": mean,
+        "maximum_2m_air_temperature": mean + 4 + 2 * dryness,
+        "minimum_2m_air_temperature": mean - 4 - 2 * dryness,
+        "dewpoint_2m_temperature": mean - 3 - 10 * dryness,
+    }
+
+
+class _Dataset:
+    """One of the synthetic ERA5 datasets."""
+
+    def __init__(self, name):
+        hourly = {"ECMWF/ERA5/HOURLY": True, "ECMWF/ERA5/DAILY": False}.get(name)
+        if hourly is None:
+            raise EEException(f"ImageCollection.load: '{name}' not found.")
+        self.name = name
+        self.hourly = hourly
+        self.band_names = list(
+            _synthetic_bands(datetime(2000, 1, 1), np.zeros(1), np.zeros(1), hourly)
+        )
+
+    def image_at(self, when):
+        def evaluate(lats, lons, memo):
+            return _synthetic_bands(when, lats, lons, self.hourly)
+
+        return Image(
+            band_names=self.band_names,
+            evaluate=evaluate,
+            description=f"{self.name}@{when.isoformat()}",
+        )
+
+    def entries(self, start=datetime(1979, 1, 1), end=datetime(2030, 1, 1)):
+        step = timedelta(hours=config["hours_step"] if self.hourly else 24)
+        count = -(-(end - start) // step)
+        return [
+            (start + i * step, self.image_at(start + i * step)) for i in range(count)
+        ]
+
+
+_token_pattern = re.compile(
+    r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)"
+    r"|([A-Za-z_$][A-Za-z0-9_$]*)"
+    r"|(\*\*|&&|\|\||==|!=|<=|>=|[-+*/%<>!?:(),=]))"
+)
+
+_binary_operators = {
+    "||": (1, np.logical_or),
+    "&&": (2, np.logical_and),
+    "==": (3, np.equal),
+    "!=": (3, np.not_equal),
+    "<": (4, np.less),
+    "<=": (4, np.less_equal),
+    ">": (4, np.greater),
+    ">=": (4, np.greater_equal),
+    "+": (5, np.add),
+    "-": (5, np.subtract),
+    "*": (6, np.multiply),
+    "/": (6, np.true_divide),
+    "%": (6, np.mod),
+    "**": (7, np.power),
+}
+
+_functions = {
+    "abs": np.abs,
+    "sqrt": np.sqrt,
+    "exp": np.exp,
+    "log": np.log,
+    "min": np.minimum,
+    "max": np.maximum,
+    "floor": np.floor,
+    "ceil": np.ceil,
+}
+
+
+@lru_cache(maxsize=None)
+def _parse_expression(expression):
+    """Parse an Earth Engine expression into (output band name, evaluate(env))."""
+    output = "constant"
+    match = re.match(r"\s*([A-Za-z_][A-Za-z0-9_]*)\s*=(?!=)", expression)
+    if match:
+        output = match.group(1)
+        expression = expression[match.end() :]
+    tokens = []
+    position = 0
+    expression = expression.rstrip()
+    while position < len(expression):
+        match = _token_pattern.match(expression, position)
+        if match is None or match.end() == position:
+            raise EEException(f"Cannot parse expression at: {expression[position:]}")
+        number, name, operator = match.groups()
+        if number is not None:
+            tokens.append(("number", float(number)))
+        elif name is not None:
+            tokens.append(("name", name))
+        else:
+            tokens.append(("op", operator))
+        position = match.end()
+    tokens.append(("end", None))
+    index = 0
+
+    def peek():
+        return tokens[index]
+
+    def take(expected=None):
+        nonlocal index
+        token = tokens[index]
+        if expected is not None and token != ("op", expected):
+            raise EEException(f"Expected {expected!r}, got {token[1]!r}")
+        index += 1
+        return token
+
+    def ternary():
+        condition = binary(1)
+        if peek() != ("op", "?"):
+            return condition
+        take("?")
+        if_true = ternary()
+        take(":")
+        if_false = ternary()
+        return lambda env: np.where(condition(env), if_true(env), if_false(env))
+
+    def binary(min_precedence):
+        left = unary()
+        while True:
+            kind, value = peek()
+            if kind != "op" or value not in _binary_operators:
+                return left
+            precedence, function = _binary_operators[value]
+            if precedence < min_precedence:
+                return left
+            take()
+            right = binary(precedence + (value != "**"))
+            left = (lambda f, a, b: lambda env: f(a(env), b(env)))(
+                function, left, right
+            )
+
+    def unary():
+        if peek() == ("op", "-"):
+            take()
+            operand = unary()
+            return lambda env: -operand(env)
+        if peek() == ("op", "+"):
+            take()
+            return unary()
+        if peek() == ("op", "!"):
+            take()
+            operand = unary()
+            return lambda env: np.logical_not(operand(env))
+        return primary()
+
+    def primary():
+        kind, value = take()
+        if kind == "number":
+            return lambda env: value
+        if kind == "name":
+            if peek() == ("op", "("):
+                take("(")
+                arguments = [ternary()]
+                while peek() == ("op", ","):
+                    take(",")
+                    arguments.append(ternary())
+                take(")")
+                function = _functions[value]
+                return lambda env: function(*(a(env) for a in arguments))
+            return lambda env: env[value]
+        if (kind, value) == ("op", "("):
+            inner = ternary()
+            take(")")
+            return inner
+        raise EEException(f"Unexpected token {value!r}")
+
+    result = ternary()
+    if peek()[0] != "end":
+        raise EEException(f"Unexpected token {peek()[1]!r}")
+
+    def evaluate(env):
+        return np.asarray(result(env), dtype=np.float64)
+
+    return output, evaluate
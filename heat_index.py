@@ -9,19 +9,42 @@ def k_to_f(k):
     return (k - 273.15) * 9 / 5 + 32
 
 
-def compute_relative_humidity(temp_k, dew_temp_k):
-    # https://bmcnoldy.earth.miami.edu/Humidity.html
-    temp_c = temp_k - 273.15
-    dew_temp_c = dew_temp_k - 273.15
-    rh = 100 * (
-        np.exp((17.625 * dew_temp_c) / (243.04 + dew_temp_c))
-        / np.exp((17.625 * temp_c) / (243.04 + temp_c))
-    )
-    rh = np.clip(rh, 0, 100)
-    return rh
+# elements per block, bounding the size of the temporaries of the kernels
+default_chunk_size = 2**18
+
 
+def compute_relative_humidity(temp_k, dew_temp_k, out=None, scratch=None):
+    """Relative humidity in percent, from temperature and dewpoint in Kelvin.
 
-def compute_heat_index(temp_k, dew_temp_k):
+    The ratio of the two Magnus exponentials is computed as one exponential,
+    of 17.625 * 243.04 * (Td - T) / ((243.04 + Td) * (243.04 + T)) with
+    temperatures in °C. Works on arrays of any (matching) shape.
+
+    Args:
+        out: Optional output array, whose dtype is used for the computation
+        scratch: Optional temporary array of the same shape as `out`
+    """
+    # https://bmcnoldy.earth.miami.edu/Humidity.html
+    temp_k, dew_temp_k = np.asarray(temp_k), np.asarray(dew_temp_k)
+    if out is None:
+        dtype = np.result_type(temp_k.dtype, dew_temp_k.dtype, np.float32)
+        out = np.empty(np.broadcast_shapes(temp_k.shape, dew_temp_k.shape), dtype)
+    if scratch is None:
+        scratch = np.empty_like(out)
+    offset = 273.15 - 243.04
+    np.subtract(dew_temp_k, offset, out=out)
+    np.subtract(temp_k, offset, out=scratch)
+    out *= scratch
+    np.subtract(dew_temp_k, temp_k, out=scratch)
+    scratch /= out
+    scratch *= 17.625 * 243.04
+    np.exp(scratch, out=out)
+    out *= 100
+    return np.clip(out, 0, 100, out=out)
+
+
+def rothfusz_regression(temp_f, rh):
+    """The full heat index regression, with adjustments, in °F."""
     # https://www.wpc.ncep.noaa.gov/html/heatindex_equation.shtml
     # The computation of the heat index is a refinement of a result
     # obtained by multiple regression analysis carried out by Lans P.
@@ -29,9 +52,6 @@ def compute_heat_index(temp_k, dew_temp_k):
     # (NWS) Technical Attachment (SR 90-23).  The regression equation
     # of Rothfusz is
 
-    temp_f = k_to_f(temp_k)
-    rh = compute_relative_humidity(temp_k, dew_temp_k)
-
     hi = (
         -42.379
         + 2.04901523 * temp_f
@@ -50,29 +70,124 @@ def compute_heat_index(temp_k, dew_temp_k):
     # temperature is between 80 and 112 degrees F, then the following
     # adjustment is subtracted from HI:
 
-    adjustment_1 = ((13 - rh) / 4) * np.sqrt((17 - np.abs(temp_f - 95.0)) / 17)
-    mask_1 = (rh < 13) & (temp_f >= 80) & (temp_f <= 112)
-    hi[mask_1] -= adjustment_1[mask_1]
+    mask = (rh < 13) & (temp_f >= 80) & (temp_f <= 112)
+    hi[mask] -= ((13 - rh[mask]) / 4) * np.sqrt((17 - np.abs(temp_f[mask] - 95.0)) / 17)
 
     # where ABS and SQRT are the absolute value and square root functions,
     # respectively.  On the other hand, if the RH is greater than 85% and
     # the temperature is between 80 and 87 degrees F, then the following
     # adjustment is added to HI:
 
-    adjustment_2 = ((rh - 85) / 10) * ((87 - temp_f) / 5)
     mask = (rh > 85) & (temp_f >= 80) & (temp_f <= 87)
-    hi[mask] += adjustment_2[mask]
+    hi[mask] += ((rh[mask] - 85) / 10) * ((87 - temp_f[mask]) / 5)
+    return hi
+
+
+def heat_index_block(temp_k, dew_temp_k, out, temp_f, rh, scratch):
+    """Heat index of 1-D blocks, using preallocated temporaries."""
+    compute_relative_humidity(temp_k, dew_temp_k, out=rh, scratch=scratch)
+    np.subtract(temp_k, 273.15, out=temp_f)
+    temp_f *= 9 / 5
+    temp_f += 32
 
     # The Rothfusz regression is not appropriate when conditions of
     # temperature and humidity warrant a heat index value below
     # about 80 degrees F. In those cases, a simpler formula is
     # applied to calculate values consistent with Steadman's results:
+    # 0.5 * (T + 61.0 + ((T - 68.0) * 1.2) + (RH * 0.094))
 
-    hi_2 = 0.5 * (temp_f + 61.0 + ((temp_f - 68.0) * 1.2) + (rh * 0.094))
+    np.multiply(temp_f, 1.1, out=out)
+    np.multiply(rh, 0.047, out=scratch)
+    out += scratch
+    out -= 10.3
 
     # In practice, the simple formula is computed first and the result averaged
     # with the temperature. If this heat index value is 80 degrees F or higher,
     # the full regression equation along with any adjustment as described above is applied.
 
-    hi_2[hi_2 >= 80] = hi[hi_2 >= 80]
-    return f_to_k(hi_2)
+    regression = np.flatnonzero(out >= 80)
+    if regression.size:
+        out[regression] = rothfusz_regression(temp_f[regression], rh[regression])
+
+    out -= 32
+    out *= 5 / 9
+    out += 273.15
+    return out
+
+
+def compute_heat_index(temp_k, dew_temp_k, out=None, chunk_size=default_chunk_size):
+    """Heat index in Kelvin, from temperature and dewpoint in Kelvin.
+
+    Inputs of any matching shape are supported, e.g. stacked (days, lat, lon)
+    arrays. They are processed in blocks of `chunk_size` elements, so memory
+    use beyond `out` is bounded, and the regression is only evaluated where
+    the simple formula gives 80°F or more.
+
+    Args:
+        out: Optional C contiguous output array. Its dtype is used for the
+            computation, by default float32, or float64 for float64 inputs.
+        chunk_size: Number of elements per block
+
+    Returns:
+        np.ndarray: `out`
+    """
+    temp_k, dew_temp_k = np.broadcast_arrays(np.asarray(temp_k), np.asarray(dew_temp_k))
+    if out is None:
+        dtype = np.result_type(temp_k.dtype, dew_temp_k.dtype, np.float32)
+        out = np.empty(temp_k.shape, dtype)
+    if out.shape != temp_k.shape or not out.flags.c_contiguous:
+        raise ValueError(f"out must be C contiguous with shape {temp_k.shape}")
+    flat_out = out.reshape(-1)
+    temp_k, dew_temp_k = temp_k.reshape(-1), dew_temp_k.reshape(-1)
+    block = min(chunk_size, flat_out.size)
+    temp_f, rh, scratch = (np.empty(block, out.dtype) for _ in range(3))
+    for start in range(0, flat_out.size, chunk_size):
+        stop = min(start + chunk_size, flat_out.size)
+        size = stop - start
+        heat_index_block(
+            temp_k[start:stop],
+            dew_temp_k[start:stop],
+            flat_out[start:stop],
+            temp_f[:size],
+            rh[:size],
+            scratch[:size],
+        )
+    return out
+
+
+def compute_heat_index_ee(temp_k, dew_temp_k):
+    """Earth Engine version of `compute_heat_index`, for single band ee.Images."""
+    temp_f = temp_k.expression("(t - 273.15) * 9 / 5 + 32", {"t": temp_k})
+    rh = temp_k.expression(
+        "100 * exp((17.625 * (d - 273.15)) / (243.04 + (d - 273.15))"
+        " - (17.625 * (t - 273.15)) / (243.04 + (t - 273.15)))",
+        {"t": temp_k, "d": dew_temp_k},
+    ).clamp(0, 100)
+    variables = {"t": temp_f, "rh": rh}
+    hi = temp_f.expression(
+        "-42.379"
+        " + 2.04901523 * t"
+        " + 10.14333127 * rh"
+        " - 0.22475541 * t * rh"
+        " - 0.00683783 * t * t"
+        " - 0.05481717 * rh * rh"
+        " + 0.00122874 * t * t * rh"
+        " + 0.00085282 * t * rh * rh"
+        " - 0.00000199 * t * t * rh * rh",
+        variables,
+    )
+    hi = hi.expression(
+        "(rh < 13 && t >= 80 && t <= 112)"
+        " ? hi - ((13 - rh) / 4) * sqrt((17 - abs(t - 95.0)) / 17)"
+        " : hi",
+        {**variables, "hi": hi},
+    )
+    hi = hi.expression(
+        "(rh > 85 && t >= 80 && t <= 87) ? hi + ((rh - 85) / 10) * ((87 - t) / 5) : hi",
+        {**variables, "hi": hi},
+    )
+    hi_2 = temp_f.expression(
+        "0.5 * (t + 61.0 + ((t - 68.0) * 1.2) + (rh * 0.094))", variables
+    )
+    hi_2 = hi_2.expression("hi_2 >= 80 ? hi : hi_2", {"hi": hi, "hi_2": hi_2})
+    return hi_2.expression("(hi - 32) * 5 / 9 + 273.15", {"hi": hi_2})
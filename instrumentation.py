@@ -0,0 +1,198 @@
+"""Per-request metrics for Earth Engine downloads.
+
+Every tile or point request made through `download` is recorded with its
+latency, pixel count, estimated decoded payload size, retry count and the statistic that
+made it (see `instrumented`). Records are kept in memory, and if the
+`WEATHER_AGG_METRICS_DIR` environment variable is set, also appended to one
+JSON lines file per process in that directory, so that metrics from pool
+workers can be aggregated afterwards:
+
+    python instrumentation.py $WEATHER_AGG_METRICS_DIR --prometheus metrics.prom
+"""
+
+import argparse
+import contextvars
+import glob
+import json
+import os
+import threading
+import time
+from functools import wraps
+
+import numpy as np
+
+metrics_dir_variable = "WEATHER_AGG_METRICS_DIR"
+
+current_statistic = contextvars.ContextVar("current_statistic", default=None)
+
+records = []
+_lock = threading.Lock()
+
+
+def instrumented(function):
+    """Attribute the requests made while `function` runs to it.
+
+    Apply below `permacache`, so cache hits are not counted as running.
+    """
+    name = f"{function.__module__}.{function.__name__}"
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        token = current_statistic.set(name)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current_statistic.reset(token)
+
+    return wrapper
+
+
+def count_values(data):
+    """Number of values in a (dictionary of) nested list(s) from getInfo."""
+    if data is None:
+        return 0
+    if isinstance(data, dict):
+        return sum(count_values(value) for value in data.values())
+    if data and isinstance(data[0], list):
+        return len(data) * len(data[0])
+    return len(data)
+
+
+def record_request(kind, latency, data, retries, error=None):
+    """Record one (possibly retried) request.
+
+    Args:
+        kind: "tile" or "point"
+        latency: Total seconds spent, including retries
+        data: Decoded result, or None if the request failed
+        retries: Number of failed attempts before the last one
+        error: The exception, if the request ultimately failed
+    """
+    statistic = current_statistic.get() or "unknown"
+    pixels = count_values(data)
+    record = dict(
+        time=time.time(),
+        kind=kind,
+        statistic=statistic,
+        module=statistic.split(".")[0],
+        latency=latency,
+        pixels=pixels,
+        # an estimate, not measured: values are decoded into 8 byte floats
+        payload_bytes_estimate=pixels * 8,
+        retries=retries,
+        error=None if error is None else repr(error),
+    )
+    with _lock:
+        records.append(record)
+        directory = os.environ.get(metrics_dir_variable)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"requests-{os.getpid()}.jsonl")
+            with open(path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+
+def load_records(directory=None):
+    """Records from every process that wrote to `directory`, or this process."""
+    if directory is None:
+        with _lock:
+            return list(records)
+    result = []
+    for path in sorted(glob.glob(os.path.join(directory, "requests-*.jsonl"))):
+        with open(path) as f:
+            result.extend(json.loads(line) for line in f if line.strip())
+    return result
+
+
+def summarize(request_records):
+    """Aggregate records per module and statistic.
+
+    Returns:
+        dict: {module: {statistic: summary}}
+    """
+    groups = {}
+    for record in request_records:
+        key = record["module"], record["statistic"]
+        groups.setdefault(key, []).append(record)
+    summary = {}
+    for (module, statistic), group in sorted(groups.items()):
+        latencies = np.array([record["latency"] for record in group])
+        summary.setdefault(module, {})[statistic] = dict(
+            requests=len(group),
+            errors=sum(record["error"] is not None for record in group),
+            retries=sum(record["retries"] for record in group),
+            pixels=sum(record["pixels"] for record in group),
+            payload_bytes_estimate=sum(
+                record["payload_bytes_estimate"] for record in group
+            ),
+            latency_total=float(latencies.sum()),
+            latency_mean=float(latencies.mean()),
+            latency_p50=float(np.percentile(latencies, 50)),
+            latency_p95=float(np.percentile(latencies, 95)),
+            latency_max=float(latencies.max()),
+        )
+    return summary
+
+
+def export_json(summary, path):
+    with open(path, "w") as f:
+        json.dump(summary, f, indent=2)
+
+
+def export_prometheus(summary, path):
+    """Write the summary in the Prometheus textfile collector format.
+
+    Latency is exported as a summary, with its median and 95th percentile.
+    """
+    counters = [
+        ("requests_total", "requests", "Earth Engine requests"),
+        ("request_errors_total", "errors", "Requests that failed"),
+        ("request_retries_total", "retries", "Retried attempts"),
+        ("pixels_total", "pixels", "Pixels downloaded"),
+        (
+            "payload_bytes_estimated_total",
+            "payload_bytes_estimate",
+            "Decoded payload, estimated at 8 bytes per pixel",
+        ),
+    ]
+    series = [
+        (values, f'module="{module}",statistic="{statistic}"')
+        for module, statistics in summary.items()
+        for statistic, values in statistics.items()
+    ]
+    lines = []
+    for metric, field, description in counters:
+        name = f"weather_agg_ee_{metric}"
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} counter")
+        for values, labels in series:
+            lines.append(f"{name}{{{labels}}} {values[field]}")
+    name = "weather_agg_ee_request_latency_seconds"
+    lines.append(f"# HELP {name} Request latency, including retries")
+    lines.append(f"# TYPE {name} summary")
+    for values, labels in series:
+        for quantile, field in [("0.5", "latency_p50"), ("0.95", "latency_p95")]:
+            lines.append(f'{name}{{{labels},quantile="{quantile}"}} {values[field]}')
+        lines.append(f"{name}_sum{{{labels}}} {values['latency_total']}")
+        lines.append(f"{name}_count{{{labels}}} {values['requests']}")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize request metrics")
+    parser.add_argument("directory", help=f"Directory ${metrics_dir_variable}")
+    parser.add_argument("--json", help="Write the summary as JSON to this path")
+    parser.add_argument("--prometheus", help="Write a Prometheus textfile")
+    args = parser.parse_args()
+    summary = summarize(load_records(args.directory))
+    if args.json:
+        export_json(summary, args.json)
+    if args.prometheus:
+        export_prometheus(summary, args.prometheus)
+    if not args.json and not args.prometheus:
+        print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,24 @@
 from datetime import datetime, timedelta
 
 import ee
-from permacache import drop_if_equal, permacache
-
-from constants import date_end_str, date_start_str
-from download import download_ee_image
+import numpy as np
+
+from constants import date_start_str, date_stop_str
+from download import (
+    download_ee_image,
+    is_image_cached,
+    is_too_expensive_error,
+    remove_journal,
+)
+from instrumentation import instrumented
+from scheduler import job_group, run_jobs
+from segments import (
+    day_weight,
+    plan_units,
+    split_on_failure,
+    weighted_mean,
+    weighted_segments,
+)
 
 # def high_temp_over_90f():
 #     ee.Initialize()
@@ -14,25 +28,111 @@ from download import download_ee_image
 #     return data.mean()
 
 
-@permacache(
-    "weather-agg-ee/mean_daily_stats/mean_daily_stats_for_segment",
-    key_function=dict(mapping_fn=drop_if_equal(None)),
-)
+@instrumented
 def mean_daily_stats_for_segment_and_timespan(
     band, filter_spec, date_start_str, date_end_str, mapping_fn=None
 ):
+    """Mean of `band` over the days of the timespan passing `filter_spec`.
+
+    Cached by its computation, see `download.download_ee_image_by_computation`.
+    """
     print(band, filter_spec, mapping_fn, date_start_str, date_end_str)
-    if mapping_fn is not None:
-        mapping_fn = mapping_fn.replace("$x", band)
-        mapping = lambda x: x.expression(mapping_fn, {band: x.select(band)})
-    else:
-        mapping = None
     return compute_daily(
-        band, filter_spec, date_start_str, date_end_str, mapping=mapping
+        band,
+        filter_spec,
+        date_start_str,
+        date_end_str,
+        mapping=expression_mapping(band, mapping_fn),
+    )
+
+
+def mean_daily_stats_cached(
+    band, filter_spec, date_start_str, date_end_str, mapping_fn=None
+):
+    image = daily_image(
+        filter_spec,
+        date_start_str,
+        date_end_str,
+        mapping=expression_mapping(band, mapping_fn),
+    )
+    return is_image_cached(image, band)
+
+
+def expression_mapping(band, mapping_fn):
+    """Mapping of each image by `mapping_fn`, in which `$x` is `band`, or None."""
+    if mapping_fn is None:
+        return None
+    mapping_fn = mapping_fn.replace("$x", band)
+    return lambda x: x.expression(mapping_fn, {band: x.select(band)})
+
+
+@instrumented
+def threshold_fractions_for_timespan(band, thresholds, date_start_str, date_end_str):
+    """Fraction of days on which `band` exceeds each threshold, in one pass.
+
+    Every threshold is a band of a single image, so the collection is reduced
+    once and all fractions are downloaded together. Cached by its computation,
+    see `download.download_ee_image_by_computation`.
+
+    Args:
+        thresholds: List of temperatures in °F
+
+    Returns:
+        np.ndarray: (len(thresholds), lat, lon) array of fractions
+    """
+    print(band, thresholds, date_start_str, date_end_str)
+    names, mapping = threshold_bands(band, thresholds)
+    result = compute_daily(
+        names, None, date_start_str, date_end_str, mapping=mapping, degree_size=None
     )
+    return np.array([result[name] for name in names])
+
+
+def threshold_bands(band, thresholds):
+    """Band names, and the mapping of each image to them, one per threshold."""
+    names = [f"gt_{idx}" for idx in range(len(thresholds))]
+
+    def mapping(x):
+        return ee.Image(
+            [
+                x.select(band).gt(threshold_kelvin(temp)).rename(name)
+                for temp, name in zip(thresholds, names)
+            ]
+        )
+
+    return names, mapping
 
 
-def compute_daily(band, filter_spec, date_start_str, date_end_str, *, mapping=None):
+def compute_daily(
+    band,
+    filter_spec,
+    date_start_str,
+    date_end_str,
+    *,
+    mapping=None,
+    degree_size=45,
+):
+    return download_ee_image(
+        daily_image(filter_spec, date_start_str, date_end_str, mapping=mapping),
+        band,
+        resolution=0.25,
+        degree_size=degree_size,
+        journal=True,
+        cache=True,
+    )
+
+
+def remove_daily_journal(band, filter_spec, date_start_str, date_end_str, mapping=None):
+    """Remove the tile journal left by a failed `compute_daily`."""
+    remove_journal(
+        daily_image(filter_spec, date_start_str, date_end_str, mapping=mapping),
+        band,
+        resolution=0.25,
+    )
+
+
+def daily_image(filter_spec, date_start_str, date_end_str, mapping=None):
+    """Mean of the (mapped) daily images passing `filter_spec` in the range."""
     ee.Initialize()
     era5 = ee.ImageCollection("ECMWF/ERA5/DAILY")
     data = era5.filter(ee.Filter.date(ee.Date(date_start_str), ee.Date(date_end_str)))
@@ -45,11 +145,7 @@ def compute_daily(band, filter_spec, date_start_str, date_end_str, *, mapping=No
     if mapping is not None:
         data = data.map(mapping)
 
-    mean_temp_for_segment = data.mean()
-
-    return download_ee_image(
-        mean_temp_for_segment, band, resolution=0.25, degree_size=45
-    )
+    return data.mean()
 
 
 def decrement(date_str):
@@ -58,30 +154,149 @@ def decrement(date_str):
     return date.strftime("%Y-%m-%d")
 
 
+# decades of daily data
+daily_units = plan_units("ECMWF/ERA5/DAILY")
+
+
+def timespan_kwargs(band, filter_spec, mapping_fn):
+    """Arguments to `segments.weighted_segments` for the study period.
+
+    Decades are preferred, and any cached timespan is reused.
+    """
+    return dict(
+        units=daily_units,
+        filter_spec=filter_spec,
+        is_cached=lambda start, end: (
+            mean_daily_stats_cached(
+                band, filter_spec, start, end, mapping_fn=mapping_fn
+            )
+        ),
+    )
+
+
+def mean_daily_stats_for_range(
+    band, filter_spec, date_start_str, date_end_str, mapping_fn=None
+):
+    """mean_daily_stats_for_segment_and_timespan, halving the range while it is
+    too expensive."""
+    return split_on_failure(
+        lambda start, end: mean_daily_stats_for_segment_and_timespan(
+            band, filter_spec, start, end, mapping_fn=mapping_fn
+        ),
+        date_start_str,
+        date_end_str,
+        is_too_expensive_error,
+        filter_spec=filter_spec,
+        on_split=lambda start, end: remove_daily_journal(
+            band, filter_spec, start, end, mapping=expression_mapping(band, mapping_fn)
+        ),
+    )
+
+
 def mean_daily_stats_for_segment(band, filter_spec, mapping_fn):
-    dates = ["1990-01-01", "2000-01-01", "2010-01-01", "2020-01-01"]
-    assert dates[0] == date_start_str and decrement(dates[-1]) == date_end_str
-    results = 0
-    total_weight = 0
-    for start, end in zip(dates[:-1], dates[1:]):
-        result = mean_daily_stats_for_segment_and_timespan(
+    return weighted_mean(
+        lambda start, end: mean_daily_stats_for_range(
             band, filter_spec, start, end, mapping_fn=mapping_fn
-        )
-        weight = (
-            datetime.strptime(end, "%Y-%m-%d") - datetime.strptime(start, "%Y-%m-%d")
-        ).days
-        results += result * weight
-        total_weight += weight
+        ),
+        date_start_str,
+        date_stop_str,
+        **timespan_kwargs(band, filter_spec, mapping_fn),
+    )
 
-    return results / total_weight
 
+seasonal_year_zero = datetime(2020, 12, 31)
 
-def for_breaks(band, year_zero, breaks):
+astronomical_breaks = [
+    datetime(2021, 1, 1),
+    datetime(2021, 3, 20),
+    datetime(2021, 6, 21),
+    datetime(2021, 9, 22),
+    datetime(2021, 12, 21),
+    datetime(2021, 12, 31),
+]
+
+# winter = DJF, spring = MAM, summer = JJA, fall = SON
+month_seasons = [[12, 1, 2], [3, 4, 5], [6, 7, 8], [9, 10, 11]]
+
+histogram_temperatures = range(-40, 150, 10)
+
+
+def break_segments(year_zero, breaks):
     breaks_days = [(x - year_zero).days for x in breaks]
-    segments = [
+    return [
         dict(type="calendarRange", start=start, end=end)
         for start, end in zip(breaks_days, breaks_days[1:])
     ]
+
+
+def month_filter_spec(month):
+    return dict(type="calendarRange", start=month, end=month, field="month")
+
+
+def day_of_year_filter_spec(day):
+    return dict(type="calendarRange", start=day, end=day)
+
+
+def threshold_kelvin(temp):
+    return 273.15 + 5 / 9 * (temp - 32)
+
+
+def threshold_mapping_fn(temp):
+    return "$x = $x > 273.15 + 5/9 * ($TEMP - 32)".replace("$TEMP", str(temp))
+
+
+def legacy_thresholds_cached(band, thresholds, date_start_str, date_end_str):
+    """Whether every threshold was cached separately, before histograms."""
+    return all(
+        mean_daily_stats_cached(
+            band,
+            None,
+            date_start_str,
+            date_end_str,
+            mapping_fn=threshold_mapping_fn(temp),
+        )
+        for temp in thresholds
+    )
+
+
+def threshold_fractions_cached(band, thresholds, date_start_str, date_end_str):
+    return legacy_thresholds_cached(
+        band, thresholds, date_start_str, date_end_str
+    ) or threshold_fractions_for_timespan_cached(
+        band, thresholds, date_start_str, date_end_str
+    )
+
+
+def threshold_fractions_for_timespan_cached(
+    band, thresholds, date_start_str, date_end_str
+):
+    names, mapping = threshold_bands(band, thresholds)
+    image = daily_image(None, date_start_str, date_end_str, mapping=mapping)
+    return is_image_cached(image, names)
+
+
+def threshold_fractions(band, thresholds, date_start_str, date_end_str):
+    """Like `threshold_fractions_for_timespan`, reusing per-threshold caches."""
+    if legacy_thresholds_cached(band, thresholds, date_start_str, date_end_str):
+        return np.array(
+            [
+                mean_daily_stats_for_segment_and_timespan(
+                    band,
+                    None,
+                    date_start_str,
+                    date_end_str,
+                    mapping_fn=threshold_mapping_fn(temp),
+                )
+                for temp in thresholds
+            ]
+        )
+    return threshold_fractions_for_timespan(
+        band, thresholds, date_start_str, date_end_str
+    )
+
+
+def for_breaks(band, year_zero, breaks):
+    segments = break_segments(year_zero, breaks)
     winter_1, spring, summer, fall, winter_2 = [
         mean_daily_stats_for_segment(band, filter_spec, None)
         for filter_spec in segments
@@ -94,69 +309,244 @@ def for_breaks(band, year_zero, breaks):
     return winter, spring, summer, fall
 
 
-def astronomical_seasonal_summary(band):
-    year_zero = datetime(2020, 12, 31)
-    breaks = [
-        datetime(2021, 1, 1),
-        datetime(2021, 3, 20),
-        datetime(2021, 6, 21),
-        datetime(2021, 9, 22),
-        datetime(2021, 12, 21),
-        datetime(2021, 12, 31),
+def day_range_summary(band, day_ranges):
+    """Mean of `band` over days of the year, from the day-of-year climatology.
+
+    Each day of the year is cached separately (see `day_of_year_filter_spec`),
+    so any summary over days of the year can be assembled without new
+    downloads once the climatology is populated.
+
+    Args:
+        day_ranges: List of inclusive (start, end) days of the year, which
+            wrap around if `end < start`
+
+    Returns:
+        np.ndarray: Day weighted mean over the given days
+    """
+    total = 0
+    total_weight = 0
+    for start, end in day_ranges:
+        days = (
+            range(start, end + 1)
+            if start <= end
+            else [*range(start, 367), *range(1, end + 1)]
+        )
+        for day in days:
+            filter_spec = day_of_year_filter_spec(day)
+            weight = day_weight(date_start_str, date_stop_str, filter_spec)
+            if weight == 0:
+                continue
+            total += mean_daily_stats_for_segment(band, filter_spec, None) * weight
+            total_weight += weight
+    return total / total_weight
+
+
+def astronomical_seasons():
+    """Inclusive day-of-year ranges of each astronomical season, winter first."""
+    segments = [
+        (spec["start"], spec["end"])
+        for spec in break_segments(seasonal_year_zero, astronomical_breaks)
     ]
+    # the first and last segments are both winter
+    return [[segments[0], segments[4]], *[[segment] for segment in segments[1:4]]]
+
+
+def astronomical_seasonal_summary(band, from_climatology=False):
+    """Winter, spring, summer and fall means of `band`.
 
-    return for_breaks(band, year_zero, breaks)
+    Args:
+        from_climatology: Assemble the seasons from the day-of-year climatology
+            instead of querying each season
+    """
+    if from_climatology:
+        return [
+            day_range_summary(band, day_ranges) for day_ranges in astronomical_seasons()
+        ]
+    return for_breaks(band, seasonal_year_zero, astronomical_breaks)
 
 
 def statistics_by_month(band):
     return [
-        mean_daily_stats_for_segment(
-            band,
-            dict(type="calendarRange", start=month, end=month, field="month"),
-            None,
-        )
+        mean_daily_stats_for_segment(band, month_filter_spec(month), None)
         for month in range(1, 1 + 12)
     ]
 
 
-def month_seasonal_summary(band):
-    year_zero = datetime(2020, 12, 31)
-    # winter = DJF, spring = MAM, summer = JJA, fall = SON
-    month_breaks = [
-        datetime(2021, 1, 1),
-        datetime(2021, 3, 1),
-        datetime(2021, 6, 1),
-        datetime(2021, 9, 1),
-        datetime(2021, 12, 1),
-        datetime(2021, 12, 31),
+def month_group_summary(band, month_groups):
+    """Means of `band` over groups of months, from the cached monthly means.
+
+    Each month is weighted by its number of days in the study period, so the
+    result matches querying the whole group at once.
+
+    Args:
+        month_groups: List of lists of months (1 to 12)
+
+    Returns:
+        list: One np.ndarray per group
+    """
+    monthly = statistics_by_month(band)
+    weights = [
+        day_weight(date_start_str, date_stop_str, month_filter_spec(month))
+        for month in range(1, 1 + 12)
+    ]
+    return [
+        sum(monthly[month - 1] * weights[month - 1] for month in group)
+        / sum(weights[month - 1] for month in group)
+        for group in month_groups
     ]
-    return for_breaks(band, year_zero, month_breaks)
 
 
-def temperature_histogram(band):
-    return {
-        temp: mean_daily_stats_for_segment(
-            band,
-            None,
-            "$x = $x > 273.15 + 5/9 * ($TEMP - 32)".replace("$TEMP", str(temp)),
+def month_seasonal_summary(band):
+    return month_group_summary(band, month_seasons)
+
+
+def temperature_histogram(band, thresholds=histogram_temperatures):
+    """Fraction of days on which `band` exceeds each threshold (in °F).
+
+    Returns:
+        dict: {threshold: np.ndarray}
+    """
+    thresholds = list(thresholds)
+    names, mapping = threshold_bands(band, thresholds)
+    fractions = weighted_mean(
+        lambda start, end: split_on_failure(
+            lambda start, end: threshold_fractions(band, thresholds, start, end),
+            start,
+            end,
+            is_too_expensive_error,
+            on_split=lambda start, end: remove_daily_journal(
+                names, None, start, end, mapping=mapping
+            ),
+        ),
+        date_start_str,
+        date_stop_str,
+        units=daily_units,
+        is_cached=lambda start, end: threshold_fractions_cached(
+            band, thresholds, start, end
+        ),
+    )
+    return dict(zip(thresholds, fractions))
+
+
+def short_name(band):
+    return band[:3] + "daily_temp"
+
+
+def segment_specs(band, day_of_year_climatology=False):
+    """(name, stat names, filter_spec, mapping_fn) for each segment of a band.
+
+    Args:
+        day_of_year_climatology: Also include one segment per day of the year,
+            for `astronomical_seasonal_summary(from_climatology=True)`
+
+    Returns:
+        list: The stat names are those that need the segment
+    """
+    short = short_name(band)
+    specs = [(short, [short], None, None)]
+    # the first and last segments are both winter
+    seasons = [1, 2, 3, 4, 1]
+    for season, filter_spec in zip(
+        seasons, break_segments(seasonal_year_zero, astronomical_breaks)
+    ):
+        name = f"{short}_seasonal_astro_{season}"
+        specs.append((name, [name], filter_spec, None))
+    for month in range(1, 1 + 12):
+        (season,) = [
+            idx for idx, months in enumerate(month_seasons, 1) if month in months
+        ]
+        stats = [f"{short}_month_{month:02d}", f"{short}_seasonal_month_{season}"]
+        specs.append((stats[0], stats, month_filter_spec(month), None))
+    if day_of_year_climatology:
+        for day in range(1, 367):
+            stats = [
+                f"{short}_seasonal_astro_{season}"
+                for season, day_ranges in enumerate(astronomical_seasons(), 1)
+                if any(start <= day <= end for start, end in day_ranges)
+            ]
+            name = f"{short}_day_{day:03d}"
+            specs.append((name, stats, day_of_year_filter_spec(day), None))
+    return specs
+
+
+def mean_daily_stats_for_segment_and_timespan_for_parallel(
+    band, filter_spec, date_start_str, date_end_str, mapping_fn
+):
+    return mean_daily_stats_for_range(
+        band, filter_spec, date_start_str, date_end_str, mapping_fn=mapping_fn
+    )
+
+
+def threshold_fractions_for_timespan_for_parallel(
+    band, thresholds, date_start_str, date_end_str
+):
+    return threshold_fractions_for_timespan(
+        band, thresholds, date_start_str, date_end_str
+    )
+
+
+def histogram_job_group(band, thresholds=histogram_temperatures):
+    thresholds = list(thresholds)
+    short = short_name(band)
+    return job_group(
+        f"{short}_histogram",
+        threshold_fractions_for_timespan_for_parallel,
+        [
+            (band, thresholds, start, end)
+            for start, end, _ in weighted_segments(
+                date_start_str,
+                date_stop_str,
+                is_cached=lambda start, end: threshold_fractions_cached(
+                    band, thresholds, start, end
+                ),
+            )
+            if not threshold_fractions_cached(band, thresholds, start, end)
+        ],
+        [f"{short}_gt_{temp:+04d}" for temp in thresholds],
+    )
+
+
+def cache_jobs(day_of_year_climatology=False):
+    arguments = {}
+    group_stats = {}
+    for band in "maximum_2m_air_temperature", "minimum_2m_air_temperature":
+        for name, stats, filter_spec, mapping_fn in segment_specs(
+            band, day_of_year_climatology
+        ):
+            group_stats[name] = stats
+            arguments.setdefault(name, []).extend(
+                (band, filter_spec, start, end, mapping_fn)
+                for start, end, _ in weighted_segments(
+                    date_start_str,
+                    date_stop_str,
+                    **timespan_kwargs(band, filter_spec, mapping_fn),
+                )
+                if not mean_daily_stats_cached(
+                    band, filter_spec, start, end, mapping_fn=mapping_fn
+                )
+            )
+    groups = [
+        job_group(
+            name,
+            mean_daily_stats_for_segment_and_timespan_for_parallel,
+            stat_arguments,
+            group_stats[name],
         )
-        for temp in range(-40, 150, 10)
-    }
+        for name, stat_arguments in arguments.items()
+    ]
+    for band in "maximum_2m_air_temperature", "minimum_2m_air_temperature":
+        groups.append(histogram_job_group(band))
+    return groups
 
 
 def populate_caches():
-    for band in "maximum_2m_air_temperature", "minimum_2m_air_temperature":
-        mean_daily_stats_for_segment(band, None, None)
-        astronomical_seasonal_summary(band)
-        month_seasonal_summary(band)
-        temperature_histogram(band)
-        statistics_by_month(band)
+    run_jobs(cache_jobs())
 
 
 def temperature_stats_dict():
     stats = {}
     for band in "maximum_2m_air_temperature", "minimum_2m_air_temperature":
-        short = band[:3] + "daily_temp"
+        short = short_name(band)
         stats[short] = mean_daily_stats_for_segment(band, None, None), "K"
         for t, value in enumerate(astronomical_seasonal_summary(band), 1):
             stats[short + "_seasonal_astro_" + str(t)] = value, "K"
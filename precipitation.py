@@ -1,4 +1,3 @@
-import multiprocessing
 from datetime import datetime
 
 import ee
@@ -6,8 +5,10 @@ import numpy as np
 from permacache import permacache
 
 from constants import date_end_str, date_start_str
-from download import download_ee_image
-from mean_daily_stats import decrement
+from download import download_ee_image, is_image_cached, is_too_expensive_error
+from instrumentation import instrumented
+from scheduler import job_group, run_jobs
+from segments import day_after, decompose, split_on_failure
 
 rain_snow_expressions = {
     "rain": "rain=(pt <= 4 ? 1 : (pt == 7 ? 0.5 : 0)) * tp",
@@ -20,6 +21,8 @@ rain_snow_expressions = {
     multiprocess_safe=True,
 )
 def compute_precipitation_for_month(rain_or_snow, start_date, end_date):
+    """Separate rain or snow total, only read for ranges cached before
+    `compute_rain_and_snow_for_month`, see `legacy_cached`."""
     print(
         f"{datetime.now()} Precipitation {rain_or_snow} from {start_date} to {end_date}"
     )
@@ -36,27 +39,117 @@ def compute_precipitation_for_month(rain_or_snow, start_date, end_date):
         )
     )
     result = download_ee_image(
-        collection.sum(), rain_or_snow, resolution=0.25, degree_size=45, pbar=False
+        collection.sum(),
+        rain_or_snow,
+        resolution=0.25,
+        degree_size=45,
+        pbar=False,
     )
     print(f"{datetime.now()} Done {rain_or_snow} from {start_date} to {end_date}")
     return result
 
 
+def rain_and_snow_image(start_date, end_date):
+    """Rain and snow totals over `[start_date, end_date)`, as two bands."""
+    ee.Initialize()
+    era5 = ee.ImageCollection("ECMWF/ERA5/HOURLY")
+    collection = era5.filter(ee.Filter.date(ee.Date(start_date), ee.Date(end_date)))
+    collection = collection.map(
+        lambda x: ee.Image(
+            [
+                x.expression(
+                    rain_snow_expressions[rain_or_snow],
+                    {
+                        "pt": x.select("precipitation_type"),
+                        "tp": x.select("total_precipitation"),
+                    },
+                )
+                for rain_or_snow in ["rain", "snow"]
+            ]
+        )
+    )
+    return collection.sum()
+
+
+@instrumented
+def compute_rain_and_snow_for_month(start_date, end_date):
+    """Monthly rain and snow totals, fetched in one request per tile.
+
+    Cached by its computation, see `download.download_ee_image_by_computation`.
+
+    Returns:
+        dict: {"rain": np.ndarray, "snow": np.ndarray}
+    """
+    print(f"{datetime.now()} Precipitation from {start_date} to {end_date}")
+    result = download_ee_image(
+        rain_and_snow_image(start_date, end_date),
+        ["rain", "snow"],
+        resolution=0.25,
+        degree_size=45,
+        pbar=False,
+        cache=True,
+    )
+    print(f"{datetime.now()} Done from {start_date} to {end_date}")
+    return result
+
+
+def rain_and_snow_cached(start_date, end_date):
+    return is_image_cached(rain_and_snow_image(start_date, end_date), ["rain", "snow"])
+
+
+def legacy_cached(start_date, end_date):
+    """Whether a range is in the separate rain and snow caches."""
+    return all(
+        compute_precipitation_for_month.cache_contains(
+            rain_or_snow, start_date, end_date
+        )
+        for rain_or_snow in ["rain", "snow"]
+    )
+
+
+def range_cached(start_date, end_date):
+    return rain_and_snow_cached(start_date, end_date) or legacy_cached(
+        start_date, end_date
+    )
+
+
+def rain_and_snow_for_range(start_date, end_date):
+    """compute_rain_and_snow_for_month, halving the range while it is too
+    expensive, and summing the halves.
+
+    Ranges that were only cached separately, before the combined request, are
+    read from there rather than fetched again.
+    """
+    if not rain_and_snow_cached(start_date, end_date) and legacy_cached(
+        start_date, end_date
+    ):
+        return {
+            rain_or_snow: compute_precipitation_for_month(
+                rain_or_snow, start_date, end_date
+            )
+            for rain_or_snow in ["rain", "snow"]
+        }
+    return split_on_failure(
+        compute_rain_and_snow_for_month,
+        start_date,
+        end_date,
+        is_too_expensive_error,
+        combine="sum",
+    )
+
+
 def compute_all_months(date_end):
-    dates = [
-        f"{year}-{month:02d}-01"
-        for year in range(1990, 2021, 1)
-        for month in range(1, 13)
-    ]
-    dates = [
-        date for date in dates if date >= date_start_str and decrement(date) <= date_end
-    ]
-    assert dates[0] == date_start_str and decrement(dates[-1]) == date_end, (
-        dates[-1],
-        date_end,
+    """Monthly segments from the start of the study period to `date_end`.
+
+    Partial months at the end are covered by days, which are summed into the
+    same month.
+    """
+    return decompose(
+        date_start_str,
+        day_after(date_end),
+        ("month",),
+        is_cached=range_cached,
     )
-    all_months = zip(dates[:-1], dates[1:])
-    return all_months
 
 
 @permacache(
@@ -70,13 +163,14 @@ def compute_precipitation(date_end=date_end_str):
     for start, end in all_months:
         _, month, _ = start.split("-")
         month_idx = int(month) - 1
-        snow_total[month_idx] += compute_precipitation_for_month("snow", start, end)
-        rain_total[month_idx] += compute_precipitation_for_month("rain", start, end)
+        rain_and_snow = rain_and_snow_for_range(start, end)
+        snow_total[month_idx] += rain_and_snow["snow"]
+        rain_total[month_idx] += rain_and_snow["rain"]
     return {"snow": np.array(snow_total), "rain": np.array(rain_total)}
 
 
-def compute_precipitation_for_month_for_parallel(rain_or_snow, start_date, end_date):
-    return compute_precipitation_for_month(rain_or_snow, start_date, end_date)
+def compute_rain_and_snow_for_month_for_parallel(start_date, end_date):
+    return rain_and_snow_for_range(start_date, end_date)
 
 
 def precipitation_stats_dict():
@@ -93,14 +187,24 @@ def precipitation_stats_dict():
     return results
 
 
-def populate_caches():
-    parameters = [
-        (ros, start, end)
-        for start, end in compute_all_months(date_end_str)
-        for ros in ["rain", "snow"]
+def cache_jobs():
+    return [
+        job_group(
+            f"precipitation_{month:02d}",
+            compute_rain_and_snow_for_month_for_parallel,
+            [
+                (start, end)
+                for start, end in compute_all_months(date_end_str)
+                if int(start.split("-")[1]) == month and not range_cached(start, end)
+            ],
+            [f"precipitation_{ros}_{month:02d}" for ros in ["rain", "snow"]],
+        )
+        for month in range(1, 13)
     ]
-    with multiprocessing.Pool(8) as pool:
-        list(pool.starmap(compute_precipitation_for_month_for_parallel, parameters))
+
+
+def populate_caches():
+    run_jobs(cache_jobs())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,115 @@
+"""Compact encoding of cached global grids.
+
+A grid is stored as `(value - offset) / scale`, either rounded to int16 or cast
+to float16, and optionally zlib compressed at its fastest level. It is decoded
+back to float32 in one vectorized step, see `decode`.
+
+With int16, values within `offset ± 32767 * scale` are kept to within
+`scale / 2`, and NaN is stored as -32768. float16 keeps about three significant
+digits of the scaled value over a much wider range.
+"""
+
+import zlib
+
+import numpy as np
+
+nan_int16 = np.iinfo(np.int16).min
+max_int16 = np.iinfo(np.int16).max
+
+
+def encoding(scale, offset=0.0, dtype="int16", compression="zlib"):
+    """Declare how a variable is encoded.
+
+    Args:
+        scale: Step between representable values, in the unit of the variable
+        offset: Value stored as 0, usually the middle of the variable's range
+        dtype: "int16" or "float16"
+        compression: None, or "zlib"
+    """
+    if dtype not in ("int16", "float16"):
+        raise ValueError(f"Unknown dtype {dtype}")
+    if compression not in (None, "zlib"):
+        raise ValueError(f"Unknown compression {compression}")
+    return dict(
+        scale=float(scale), offset=float(offset), dtype=dtype, compression=compression
+    )
+
+
+# per-date variables, passed explicitly to their caches; int16 steps of 0.01
+# cover ±327 around the offsets
+encodings = dict(
+    dewpoint_temperature_2m=encoding(0.01, 250),
+    maximum_2m_air_temperature=encoding(0.01, 260),
+    wind_speed=encoding(0.01),
+)
+
+
+def encode(array, variable_encoding):
+    """Encode a grid, see `encoding`.
+
+    Returns:
+        dict: With the `encoding`, the `shape` and the encoded bytes as `data`
+    """
+    offset, scale = variable_encoding["offset"], variable_encoding["scale"]
+    scaled = (np.asarray(array, dtype=np.float64) - offset) / scale
+    if variable_encoding["dtype"] == "int16":
+        valid = ~np.isnan(scaled)
+        if np.any(np.abs(scaled[valid]) > max_int16):
+            raise ValueError(f"Values out of the range of {variable_encoding}")
+        data = np.where(valid, np.rint(np.where(valid, scaled, 0)), nan_int16)
+        data = data.astype(np.int16)
+    else:
+        data = scaled.astype(np.float16)
+    raw = data.tobytes()
+    if variable_encoding["compression"] == "zlib":
+        raw = zlib.compress(raw, 1)
+    return dict(encoding=variable_encoding, shape=data.shape, data=raw)
+
+
+def is_encoded(value):
+    return isinstance(value, dict) and "encoding" in value and "data" in value
+
+
+def decoded_like(value):
+    """(shape, dtype) of a grid once decoded."""
+    if is_encoded(value):
+        return tuple(value["shape"]), np.dtype(np.float32)
+    value = np.asarray(value)
+    return value.shape, value.dtype
+
+
+def decode(value, out=None):
+    """Decode a grid to float32, into `out` if given.
+
+    Values that are not encoded, such as cache entries written before the
+    encoding was introduced, are returned (or copied into `out`) as they are.
+    """
+    if not is_encoded(value):
+        if out is None:
+            return value
+        out[...] = value
+        return out
+    variable_encoding = value["encoding"]
+    raw = value["data"]
+    if variable_encoding["compression"] == "zlib":
+        raw = zlib.decompress(raw)
+    data = np.frombuffer(raw, dtype=variable_encoding["dtype"]).reshape(value["shape"])
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    np.multiply(data, np.float32(variable_encoding["scale"]), out=out)
+    out += np.float32(variable_encoding["offset"])
+    if variable_encoding["dtype"] == "int16":
+        out[data == nan_int16] = np.nan
+    return out
+
+
+def encode_fields(fields, field_encodings):
+    """Encode the grids of a dictionary from variable name to grid, each with
+    its encoding in `field_encodings`."""
+    return {
+        name: encode(value, field_encodings[name]) for name, value in fields.items()
+    }
+
+
+def decode_fields(fields):
+    return {name: decode(value) for name, value in fields.items()}
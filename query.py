@@ -0,0 +1,188 @@
+"""Look up computed statistics at locations, from the store `all_stats` writes.
+
+    python query.py [--stats a,b] [--interpolate] point 40.7 -74.0
+    python query.py [--stats a,b] [--interpolate] batch locations.csv
+    python query.py serve [--port 8000]
+
+The service answers `GET /stats` with every stat and its unit, and
+`GET /query?lat=40.7,51.5&lon=-74.0,-0.1[&stats=a,b][&interpolate=1]` or
+`POST /query` with a JSON body of the same fields (as lists) with the value
+of each stat at each location.
+
+Only numpy and `stats_store` are imported, so the service starts quickly.
+"""
+
+import argparse
+import csv
+import json
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from stats_store import StatsStore, default_store_path, fractional_cell
+
+
+def query(store, lats, lons, stats=None, interpolate=False):
+    """Values of statistics at many locations at once.
+
+    Args:
+        store: An open `StatsStore`
+        lats, lons: Latitudes and longitudes, scalars or arrays of the same shape
+        stats: Names of the stats to return (default: all)
+        interpolate: Bilinearly interpolate between the four surrounding cells
+            instead of taking the nearest cell
+
+    Returns:
+        dict: {stat name: np.ndarray of values, shaped like `lats`}
+    """
+    lats, lons = np.broadcast_arrays(
+        np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    )
+    stats = store.stat_names if stats is None else list(stats)
+    unknown = [name for name in stats if name not in store.units]
+    if unknown:
+        raise KeyError(f"Unknown stats: {unknown}")
+    rows, cols = fractional_cell(lats, lons, store.resolution)
+    num_rows, num_cols = store.shape
+    if not interpolate:
+        rows = np.clip(np.round(rows).astype(int), 0, num_rows - 1)
+        cols = np.round(cols).astype(int) % num_cols
+        return {name: store.read_cells(name, rows, cols) for name in stats}
+    rows = np.clip(rows, 0, num_rows - 1)
+    top = np.minimum(np.floor(rows).astype(int), num_rows - 2)
+    left = np.floor(cols).astype(int)
+    row_weight, col_weight = rows - top, cols - left
+    # longitudes wrap around, latitudes are clamped at the poles
+    left, right = left % num_cols, (left + 1) % num_cols
+    corners = [
+        (top, left, (1 - row_weight) * (1 - col_weight)),
+        (top, right, (1 - row_weight) * col_weight),
+        (top + 1, left, row_weight * (1 - col_weight)),
+        (top + 1, right, row_weight * col_weight),
+    ]
+    return {
+        name: sum(
+            store.read_cells(name, corner_rows, corner_cols) * weight
+            for corner_rows, corner_cols, weight in corners
+        ).astype(np.float32)
+        for name in stats
+    }
+
+
+def to_json(results):
+    """JSON compatible lists, with NaN (no data) as null."""
+    return {
+        name: [None if np.isnan(value) else float(value) for value in values.ravel()]
+        for name, values in results.items()
+    }
+
+
+def parse_list(value, dtype=str):
+    if isinstance(value, list):
+        return [dtype(item) for item in value]
+    return [dtype(item) for item in value.split(",") if item]
+
+
+def make_handler(store):
+    class QueryHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def answer(self, path, params):
+            if path == "/stats":
+                return self.send_json(200, store.units)
+            if path != "/query":
+                return self.send_json(404, dict(error=f"Unknown path {path}"))
+            missing = [key for key in ("lat", "lon") if key not in params]
+            if missing:
+                return self.send_json(400, dict(error=f"Missing {missing}"))
+            try:
+                lats = parse_list(params["lat"], float)
+                lons = parse_list(params["lon"], float)
+                stats = params.get("stats")
+                results = query(
+                    store,
+                    lats,
+                    lons,
+                    stats=None if stats is None else parse_list(stats),
+                    interpolate=str(params.get("interpolate", "0")).lower()
+                    in ("1", "true"),
+                )
+            except (KeyError, ValueError) as e:
+                return self.send_json(400, dict(error=str(e.args[0])))
+            self.send_json(200, dict(lat=lats, lon=lons, values=to_json(results)))
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            self.answer(url.path, params)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                params = json.loads(self.rfile.read(length) or b"{}")
+            except ValueError as e:
+                return self.send_json(400, dict(error=f"Invalid JSON: {e}"))
+            self.answer(urlparse(self.path).path, params)
+
+    return QueryHandler
+
+
+def serve(store, host="127.0.0.1", port=8000):
+    server = ThreadingHTTPServer((host, port), make_handler(store))
+    print(f"Serving {len(store.units)} stats on http://{host}:{port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--store", default=default_store_path)
+    parser.add_argument("--stats", help="Only these (comma separated) stats")
+    parser.add_argument("--interpolate", action="store_true")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    point_parser = subparsers.add_parser("point")
+    point_parser.add_argument("lat", type=float)
+    point_parser.add_argument("lon", type=float)
+    batch_parser = subparsers.add_parser("batch", help="CSV with lat,lon columns")
+    batch_parser.add_argument("path")
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("--host", default="127.0.0.1")
+    serve_parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    with StatsStore(args.store) as store:
+        if args.command == "serve":
+            return serve(store, args.host, args.port)
+        if args.command == "point":
+            lats, lons = [args.lat], [args.lon]
+        else:
+            with open(args.path) as f:
+                rows = list(csv.DictReader(f))
+            lats = [float(row["lat"]) for row in rows]
+            lons = [float(row["lon"]) for row in rows]
+        stats = None if args.stats is None else parse_list(args.stats)
+        results = query(store, lats, lons, stats, args.interpolate)
+        if args.command == "point":
+            for name, values in results.items():
+                print(f"{name}\t{values[0]:.6g}\t{store.units[name]}")
+            return
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["lat", "lon", *results])
+        for idx, (lat, lon) in enumerate(zip(lats, lons)):
+            writer.writerow([lat, lon, *(values[idx] for values in results.values())])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+"""Streaming reduction of per-date grids into statistics.
+
+Statistics are declared with `statistic` and computed by `reduce_dates`, which
+loads the per-date arrays in blocks of `block_size` dates and reduces each
+block vectorized into preallocated accumulators. Partial state can be
+checkpointed, so an interrupted reduction resumes where it stopped.
+
+Given tolerances, `reduce_dates` stops as soon as the standard errors of the
+means and fractions are within them, so that converged statistics do not
+need every date. Dates should then be in shuffled order, as from
+`sample.compute_date_strs`.
+
+Given a weighting, such as `sample.stratum_weights`, fractions, means,
+variances and their standard errors are weighted estimates.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import tqdm
+
+import quantize
+import sketch
+
+checkpoint_folder = "reduce_checkpoints"
+
+reductions = (
+    "fraction_above",
+    "count_above",
+    "sum",
+    "mean",
+    "variance",
+    "std",
+    "histogram",
+)
+
+
+def statistic(name, reduction, field, unit, *, threshold=None, edges=None):
+    """Declare a statistic computed over dates.
+
+    Args:
+        name: Name of the resulting statistic
+        reduction: One of `reductions`. The "_above" reductions need a
+            `threshold`, and count dates on which the field exceeds it.
+            "variance" and "std" are population statistics, computed with
+            Welford's algorithm. "histogram" needs bin `edges`, and results
+            in a sketch, see `sketch`. "count_above", "sum" and "histogram"
+            are unweighted.
+        field: Name of the per-date field to reduce
+        unit: Unit of the field
+    """
+    if reduction not in reductions:
+        raise ValueError(f"Unknown reduction {reduction}")
+    if reduction.endswith("_above") and threshold is None:
+        raise ValueError(f"{reduction} needs a threshold")
+    if not reduction.endswith("_above") and threshold is not None:
+        raise ValueError(f"{reduction} does not take a threshold")
+    if (reduction == "histogram") != (edges is not None):
+        raise ValueError("Edges are needed for, and only for, histograms")
+    return dict(
+        name=name,
+        reduction=reduction,
+        field=field,
+        unit=unit,
+        threshold=threshold,
+        edges=None if edges is None else [float(edge) for edge in edges],
+    )
+
+
+def checkpoint_key(date_strs, statistics, weights=None):
+    """Identifies a reduction, so checkpoints of other reductions are ignored."""
+    weights = None if weights is None else [float(w) for w in weights]
+    spec = json.dumps([list(date_strs), statistics, weights], sort_keys=True)
+    return hashlib.sha256(spec.encode("utf-8")).hexdigest()
+
+
+def initial_state(statistics, shape):
+    # weight and weight2 are the sums of the weights and their squares
+    state = dict(processed=0, weight=0.0, weight2=0.0)
+    for stat in statistics:
+        prefix, reduction = stat["name"], stat["reduction"]
+        if reduction == "count_above":
+            state[f"{prefix}/count"] = np.zeros(shape, dtype=np.int32)
+        elif reduction == "fraction_above":
+            state[f"{prefix}/count"] = np.zeros(shape, dtype=np.float64)
+        elif reduction == "sum":
+            state[f"{prefix}/sum"] = np.zeros(shape, dtype=np.float64)
+        elif reduction == "histogram":
+            state[f"{prefix}/counts"] = sketch.empty_counts(stat["edges"], shape)
+        else:
+            state[f"{prefix}/mean"] = np.zeros(shape, dtype=np.float64)
+            state[f"{prefix}/m2"] = np.zeros(shape, dtype=np.float64)
+    return state
+
+
+def save_checkpoint(path, key, state):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary = f"{path}.tmp.npz"
+    np.savez(temporary, key=key, **state)
+    os.replace(temporary, path)
+
+
+def load_checkpoint(path, key):
+    """Saved state for this reduction, or None."""
+    if path is None or not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        if str(data["key"]) != key:
+            return None
+        state = {name: data[name] for name in data.files if name != "key"}
+    state["processed"] = int(state["processed"])
+    state["weight"] = float(state["weight"])
+    state["weight2"] = float(state["weight2"])
+    return state
+
+
+def reduce_block(state, statistics, fields, weights=None):
+    """Update the accumulators with a block of dates.
+
+    Args:
+        fields: Dictionary from field name to a (dates, lat, lon) array
+        weights: Weight of each date of the block, or None for equal weights
+    """
+    processed, weight = state["processed"], state["weight"]
+    count = len(next(iter(fields.values())))
+    block_weight = count if weights is None else float(weights.sum())
+    for stat in statistics:
+        values = fields[stat["field"]]
+        prefix = stat["name"]
+        if stat["reduction"] == "count_above":
+            state[f"{prefix}/count"] += np.count_nonzero(
+                values > stat["threshold"], axis=0
+            ).astype(np.int32)
+        elif stat["reduction"] == "fraction_above" and weights is None:
+            state[f"{prefix}/count"] += np.count_nonzero(
+                values > stat["threshold"], axis=0
+            )
+        elif stat["reduction"] == "fraction_above":
+            state[f"{prefix}/count"] += np.tensordot(
+                weights, values > stat["threshold"], axes=1
+            )
+        elif stat["reduction"] == "sum":
+            state[f"{prefix}/sum"] += values.sum(axis=0, dtype=np.float64)
+        elif stat["reduction"] == "histogram":
+            if processed + len(values) > sketch.max_count:
+                raise ValueError(f"Too many dates for the uint16 counts of {prefix}")
+            sketch.update_counts(state[f"{prefix}/counts"], stat["edges"], values)
+        else:
+            # combine the block's mean and M2 with the running ones (Chan et al.)
+            if weights is None:
+                block_mean = values.mean(axis=0, dtype=np.float64)
+                block_m2 = values.var(axis=0, dtype=np.float64) * count
+            else:
+                block_mean = np.tensordot(weights, values, axes=1) / block_weight
+                block_m2 = np.tensordot(weights, (values - block_mean) ** 2, axes=1)
+            mean, m2 = state[f"{prefix}/mean"], state[f"{prefix}/m2"]
+            total = weight + block_weight
+            delta = block_mean - mean
+            m2 += block_m2 + delta**2 * (weight * block_weight / total)
+            mean += delta * (block_weight / total)
+    state["processed"] += count
+    state["weight"] += block_weight
+    state["weight2"] += count if weights is None else float((weights**2).sum())
+
+
+def finish(state, statistics):
+    """Final (value, unit) of each statistic."""
+    count, weight = state["processed"], state["weight"]
+    result = {}
+    for stat in statistics:
+        prefix, reduction = stat["name"], stat["reduction"]
+        if reduction == "count_above":
+            value = state[f"{prefix}/count"]
+        elif reduction == "fraction_above":
+            value = state[f"{prefix}/count"] / weight
+        elif reduction == "sum":
+            value = state[f"{prefix}/sum"]
+        elif reduction == "mean":
+            value = state[f"{prefix}/mean"].copy()
+        elif reduction == "histogram":
+            value = dict(
+                edges=np.array(stat["edges"]), counts=state[f"{prefix}/counts"]
+            )
+        elif reduction == "variance":
+            value = state[f"{prefix}/m2"] / weight
+        else:
+            value = np.sqrt(state[f"{prefix}/m2"] / weight)
+        result[prefix] = value, stat["unit"]
+        if reduction in ("mean", "fraction_above"):
+            result[f"{prefix}_stderr"] = standard_error(state, stat), stat["unit"]
+    result["dates_used"] = count, "dates"
+    return result
+
+
+def standard_error(state, stat):
+    """Per-pixel standard error of a mean or fraction statistic.
+
+    Weighted estimates use the effective number of dates, (Σw)² / Σw².
+    """
+    weight = state["weight"]
+    effective = weight**2 / state["weight2"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if stat["reduction"] == "fraction_above":
+            fraction = state[f"{stat['name']}/count"] / weight
+            return np.sqrt(fraction * (1 - fraction) / effective)
+        return np.sqrt(state[f"{stat['name']}/m2"] / weight / (effective - 1))
+
+
+def converged(state, statistics, tolerances, error_quantile):
+    """Whether the `error_quantile` over pixels of each standard error is within
+    the statistic's tolerance."""
+    for stat in statistics:
+        if stat["name"] not in tolerances:
+            continue
+        error = np.nanquantile(standard_error(state, stat), error_quantile)
+        if not error <= tolerances[stat["name"]]:
+            return False
+    return True
+
+
+def reduce_dates(
+    load,
+    date_strs,
+    statistics,
+    *,
+    derived=None,
+    block_size=32,
+    checkpoint_path=None,
+    checkpoint_every=8,
+    tolerances=None,
+    error_quantile=0.95,
+    min_dates=100,
+    weights=None,
+    desc=None,
+):
+    """Reduce per-date grids into statistics.
+
+    Args:
+        load: Function from a date string to a dictionary from field name to
+            a (lat, lon) array, usually a cached download. Arrays encoded by
+            `quantize` are decoded straight into the block.
+        date_strs: Dates to reduce over
+        statistics: List of statistics, from `statistic`
+        derived: Dictionary from field name to a function computing it from the
+            dictionary of loaded (dates, lat, lon) blocks, e.g. heat index. It
+            is called as `compute(fields, out=out)`, where `out` is None for
+            the first block, and then its previous result, to be reused.
+        checkpoint_path: If given, the partial state is saved there every
+            `checkpoint_every` blocks, and a matching checkpoint is resumed
+            from. It is removed once the reduction finishes.
+        tolerances: Dictionary from the name of a "mean" or "fraction_above"
+            statistic to the standard error, in its unit, that is good enough.
+            If given, the reduction stops once the `error_quantile` over
+            pixels of each of these standard errors is within its tolerance,
+            after at least `min_dates` dates.
+        weights: Function from a list of dates to the weight of each, e.g.
+            `sample.stratum_weights`. None weighs dates equally. Since the
+            weights depend on which dates are used, the dates reduced before
+            an early stop are reduced again with their own weights.
+
+    Returns:
+        dict: {name: (value, unit)}, as well as {name}_stderr for each mean and
+            fraction, and the number of "dates_used"
+    """
+    if tolerances is not None:
+        by_name = {stat["name"]: stat for stat in statistics}
+        for name in tolerances:
+            if name not in by_name:
+                raise ValueError(f"Tolerance for unknown statistic {name}")
+            if by_name[name]["reduction"] not in ("mean", "fraction_above"):
+                raise ValueError(f"No standard error for {name}")
+    derived = derived or {}
+    planned_weights = None if weights is None else weights(date_strs)
+    key = checkpoint_key(date_strs, statistics, planned_weights)
+    state = load_checkpoint(checkpoint_path, key)
+    buffers = None
+    derived_buffers = {}
+    blocks = range(
+        0 if state is None else state["processed"], len(date_strs), block_size
+    )
+    for block_idx, start in enumerate(tqdm.tqdm(blocks, desc=desc, unit="block")):
+        block_dates = date_strs[start : start + block_size]
+        for idx, date_str in enumerate(block_dates):
+            loaded = load(date_str)
+            if buffers is None:
+                # no later block is longer than the first, which may be short
+                buffers = {}
+                for name, value in loaded.items():
+                    shape, dtype = quantize.decoded_like(value)
+                    buffers[name] = np.empty((len(block_dates), *shape), dtype=dtype)
+            if state is None:
+                shape = next(iter(buffers.values())).shape[1:]
+                state = initial_state(statistics, shape)
+            for name, value in loaded.items():
+                quantize.decode(value, out=buffers[name][idx])
+        fields = {name: buffer[: len(block_dates)] for name, buffer in buffers.items()}
+        for name, compute in derived.items():
+            out = derived_buffers.get(name)
+            out = None if out is None else out[: len(block_dates)]
+            fields[name] = compute(fields, out=out)
+            derived_buffers.setdefault(name, fields[name])
+        block_weights = (
+            None
+            if weights is None
+            else np.asarray(
+                planned_weights[start : start + block_size], dtype=np.float64
+            )
+        )
+        reduce_block(state, statistics, fields, block_weights)
+        if checkpoint_path is not None and (block_idx + 1) % checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, key, state)
+        if (
+            tolerances
+            and state["processed"] >= min_dates
+            and converged(state, statistics, tolerances, error_quantile)
+        ):
+            break
+    if state is None:
+        raise ValueError("No dates to reduce")
+    if checkpoint_path is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if weights is not None and state["processed"] < len(date_strs):
+        # the planned weights were for all of `date_strs`; the loads are cached
+        return reduce_dates(
+            load,
+            date_strs[: state["processed"]],
+            statistics,
+            derived=derived,
+            block_size=block_size,
+            weights=weights,
+            desc=desc,
+        )
+    return finish(state, statistics)
@@ -1,5 +1,7 @@
+from collections import Counter
 from datetime import datetime, timedelta
 
+import ee
 import numpy as np
 import tqdm
 
@@ -15,6 +17,17 @@ def sampled_values(fn, num_samples, quiet=True):
         yield fn(date_str)
 
 
+def sampled_date_collection(image_for_date, num_samples):
+    """Earth Engine collection of `image_for_date` over the sampled dates.
+
+    Reducing this collection server-side gives the same statistic as reducing
+    `sampled_values` locally, without downloading each date.
+    """
+    return ee.ImageCollection(
+        [image_for_date(date_str) for date_str in compute_date_strs()[:num_samples]]
+    )
+
+
 def compute_date_strs():
     start_date = datetime.strptime(date_start_str, "%Y-%m-%d").date()
     num_dates = (
@@ -28,3 +41,55 @@ def compute_date_strs():
     ]
 
     return date_strs
+
+
+def sample_date_strs(count, stratified=False):
+    """The first `count` sampled dates, uniformly or stratified."""
+    return (stratified_date_strs() if stratified else compute_date_strs())[:count]
+
+
+def stratum(date_str):
+    """Calendar month and year of a date, e.g. "1995-07"."""
+    return date_str[:7]
+
+
+def stratified_date_strs():
+    """All dates, ordered so that every prefix is balanced across months and years.
+
+    The k-th of the N dates of a stratum is placed at (k + u) / N, for a random
+    offset u per stratum, so any prefix holds each stratum in proportion to its
+    number of days, to within one date. Prefixes are thus nearly self-weighting,
+    and `stratum_weights` corrects the remainder.
+    """
+    by_stratum = {}
+    # compute_date_strs is shuffled, so dates are in random order per stratum
+    for date_str in compute_date_strs():
+        by_stratum.setdefault(stratum(date_str), []).append(date_str)
+    offsets = np.random.RandomState(1).uniform(size=len(by_stratum))
+    keys, date_strs = [], []
+    for offset, dates in zip(offsets, by_stratum.values()):
+        for k, date_str in enumerate(dates):
+            keys.append((k + offset) / len(dates))
+            date_strs.append(date_str)
+    return [date_strs[i] for i in np.argsort(keys, kind="stable")]
+
+
+def stratum_weights(date_strs):
+    """Weights making a reduction over `date_strs` a stratified estimate.
+
+    Each date is weighted by its stratum's share of all days over its share of
+    `date_strs`, so the weights average to 1 when every stratum is sampled.
+    """
+    counts = Counter(stratum(date_str) for date_str in date_strs)
+    sizes = Counter(stratum(date_str) for date_str in compute_date_strs())
+    total = sum(sizes.values())
+    weight = {
+        key: sizes[key] / total * len(date_strs) / count
+        for key, count in counts.items()
+    }
+    return np.array([weight[stratum(date_str)] for date_str in date_strs])
+
+
+def batches(items, size):
+    """Split a list into consecutive batches of at most `size` items."""
+    return [items[i : i + size] for i in range(0, len(items), size)]
@@ -0,0 +1,123 @@
+import multiprocessing
+import threading
+import time
+
+import tqdm
+
+from download import set_request_slots
+
+
+def job_group(name, function, arguments, stats):
+    """A group of cache population jobs that together unblock some statistics.
+
+    Args:
+        name: Name of the group, for progress reporting
+        function: Picklable module-level function to run for each job
+        arguments: List of argument tuples, one per job still to run. Jobs whose
+            results are already cached should be left out.
+        stats: Names of the statistics in `all_stats.all_stats` that need every
+            job in this group
+    """
+    return dict(name=name, function=function, arguments=arguments, stats=stats)
+
+
+def prioritize(groups):
+    """Flatten job groups into a single queue of (name, function, args) jobs.
+
+    Groups that unblock the most statistics per remaining job come first, so
+    statistics become computable as early as possible. Jobs shared between
+    groups are only run once.
+    """
+    groups = [group for group in groups if group["arguments"]]
+    groups = sorted(
+        groups,
+        key=lambda group: len(group["stats"]) / len(group["arguments"]),
+        reverse=True,
+    )
+    queue = []
+    seen = set()
+    for group in groups:
+        for args in group["arguments"]:
+            key = (group["function"].__module__, group["function"].__name__, repr(args))
+            if key in seen:
+                continue
+            seen.add(key)
+            queue.append((group["name"], group["function"], args))
+    return queue
+
+
+def run_jobs(groups, processes=8, max_jobs_per_second=None, max_requests=16):
+    """Run cache population jobs from several modules through one process pool.
+
+    At most `processes` jobs are in flight at once, and new jobs are started at
+    most `max_jobs_per_second` times per second, across all modules. Since each
+    job fetches several tiles concurrently, Earth Engine requests are limited
+    separately: at most `max_requests` are in flight across all workers, or
+    None for no limit. Progress, throughput and ETA are reported with a single
+    progress bar.
+
+    Returns:
+        list: (name, args, exception) for each job that failed
+    """
+    queue = prioritize(groups)
+    slots = threading.BoundedSemaphore(processes)
+    failures = []
+    lock = threading.Lock()
+    start = time.time()
+    last_dispatch = 0
+
+    request_slots = (
+        None if max_requests is None else multiprocessing.BoundedSemaphore(max_requests)
+    )
+    with multiprocessing.Pool(
+        processes, initializer=set_request_slots, initargs=(request_slots,)
+    ) as pool, tqdm.tqdm(
+        total=len(queue), unit="job", desc="Populating caches"
+    ) as pbar:
+
+        def finished(name, args):
+            def callback(_):
+                with lock:
+                    pbar.update(1)
+                    pbar.set_postfix(group=name, failed=len(failures))
+                slots.release()
+
+            def error_callback(e):
+                with lock:
+                    failures.append((name, args, e))
+                    pbar.update(1)
+                    pbar.set_postfix(group=name, failed=len(failures))
+                print(f"Job {name}{args} failed: {e!r}")
+                slots.release()
+
+            return callback, error_callback
+
+        results = []
+        for name, function, args in queue:
+            slots.acquire()
+            if max_jobs_per_second is not None:
+                wait = last_dispatch + 1 / max_jobs_per_second - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                last_dispatch = time.time()
+            callback, error_callback = finished(name, args)
+            results.append(
+                pool.apply_async(
+                    function, args, callback=callback, error_callback=error_callback
+                )
+            )
+        for result in results:
+            result.wait()
+
+    elapsed = time.time() - start
+    print(
+        f"Ran {len(queue)} jobs in {elapsed:.0f}s"
+        f" ({len(queue) / max(elapsed, 1e-9):.2f} jobs/s), {len(failures)} failed"
+    )
+    return failures
+
+
+if __name__ == "__main__":
+    from all_stats import cache_jobs
+
+    run_jobs(cache_jobs())
@@ -0,0 +1,240 @@
+"""Date range aggregates composed from cached segments.
+
+A statistic over a date range is computed per aligned segment (a decade, year,
+month or day, as `[start, end)` date strings), and segments are combined by
+their day weight. Since segments are aligned, extending the study period only
+adds new segments; the cached ones are reused.
+
+`plan_units` picks the units from the size of the reduced collection, and
+`split_on_failure` halves any segment whose reduction is still too expensive.
+"""
+
+from datetime import datetime, timedelta
+
+date_format = "%Y-%m-%d"
+
+# largest first
+segment_units = ("decade", "year", "month", "day")
+
+# longest segment of each unit, in days
+unit_max_days = dict(decade=3653, year=366, month=31, day=1)
+
+# images per day of the collections that are reduced over segments
+images_per_day = {"ECMWF/ERA5/HOURLY": 24, "ECMWF/ERA5/DAILY": 1}
+
+# a year of hourly data is the largest reduction known to succeed
+max_request_images = 24 * 366
+
+
+def parse_date(date_str):
+    return datetime.strptime(date_str, date_format)
+
+
+def format_date(date):
+    return date.strftime(date_format)
+
+
+def day_after(date_str):
+    return format_date(parse_date(date_str) + timedelta(days=1))
+
+
+def segment_end(start, unit):
+    """End of the `unit` segment starting at `start`, or None if not aligned."""
+    if unit == "day":
+        return start + timedelta(days=1)
+    if unit == "month":
+        if start.day != 1:
+            return None
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+    if start.day != 1 or start.month != 1:
+        return None
+    if unit == "year":
+        return start.replace(year=start.year + 1)
+    if unit == "decade":
+        if start.year % 10 != 0:
+            return None
+        return start.replace(year=start.year + 10)
+    raise ValueError(f"Unknown segment unit {unit}")
+
+
+def decompose(date_start_str, date_end_str, units=segment_units, is_cached=None):
+    """Split `[date_start_str, date_end_str)` into aligned segments.
+
+    Each segment is the largest aligned unit that fits, preferring segments for
+    which `is_cached(start, end)` is true, so that previously computed
+    segments are reused even if a larger unit would now fit.
+
+    Args:
+        units: Units to use, largest first. Days are always allowed, so that
+            any range can be covered.
+
+    Returns:
+        list: (start, end) date string pairs
+    """
+    units = [unit for unit in units if unit != "day"] + ["day"]
+    start, stop = parse_date(date_start_str), parse_date(date_end_str)
+    segments = []
+    while start < stop:
+        candidates = []
+        for unit in units:
+            end = segment_end(start, unit)
+            if end is not None and end <= stop:
+                candidates.append((format_date(start), format_date(end)))
+        if is_cached is not None:
+            cached = [candidate for candidate in candidates if is_cached(*candidate)]
+            candidates = cached or candidates
+        segments.append(candidates[0])
+        start = parse_date(candidates[0][1])
+    return segments
+
+
+def plan_units(collection, max_images=max_request_images, units=segment_units):
+    """Units of the segments over which to reduce `collection`, largest first.
+
+    Units whose longest segment has more than `max_images` images are left
+    out, e.g. decades of hourly data.
+    """
+    per_day = images_per_day[collection]
+    return tuple(unit for unit in units if unit_max_days[unit] * per_day <= max_images)
+
+
+def midpoint(date_start_str, date_end_str):
+    start, stop = parse_date(date_start_str), parse_date(date_end_str)
+    return format_date(start + timedelta(days=(stop - start).days // 2))
+
+
+def split_on_failure(
+    compute_segment,
+    date_start_str,
+    date_end_str,
+    should_split,
+    *,
+    combine="mean",
+    filter_spec=None,
+    on_split=None,
+):
+    """Compute a segment, recursively halving it while the computation fails.
+
+    Args:
+        compute_segment: Function from (start, end) to the mean or sum over that
+            segment, usually cached. Sums may be dictionaries of arrays, which
+            are summed per key.
+        should_split: Function from an exception to whether a shorter range
+            might succeed, e.g. `download.is_too_expensive_error`
+        combine: "mean", to combine halves by their day weight, or "sum". Hourly
+            collections have as many images every day, so day weights are
+            also hour weights.
+        filter_spec: Filter of the days, for the day weights, see `day_weight`
+        on_split: Function called with (start, end) of a failed range once its
+            halves are computed, e.g. to remove its partial tile journal
+    """
+    try:
+        return compute_segment(date_start_str, date_end_str)
+    except Exception as e:
+        if not should_split(e) or day_after(date_start_str) >= date_end_str:
+            raise
+        print(f"Segment {date_start_str} to {date_end_str} failed ({e}); halving")
+    middle = midpoint(date_start_str, date_end_str)
+    halves = [(date_start_str, middle), (middle, date_end_str)]
+    kwargs = dict(combine=combine, filter_spec=filter_spec, on_split=on_split)
+    if combine == "sum":
+        first, second = [
+            split_on_failure(compute_segment, start, end, should_split, **kwargs)
+            for start, end in halves
+        ]
+        if isinstance(first, dict):
+            result = {name: first[name] + second[name] for name in first}
+        else:
+            result = first + second
+    else:
+        total = 0
+        total_weight = 0
+        for start, end in halves:
+            weight = day_weight(start, end, filter_spec)
+            if weight == 0:
+                continue
+            total += (
+                split_on_failure(compute_segment, start, end, should_split, **kwargs)
+                * weight
+            )
+            total_weight += weight
+        result = total / total_weight
+    if on_split is not None:
+        on_split(date_start_str, date_end_str)
+    return result
+
+
+def calendar_value(date, field):
+    if field == "day_of_year":
+        return date.timetuple().tm_yday
+    if field == "month":
+        return date.month
+    if field == "year":
+        return date.year
+    raise ValueError(f"Unsupported calendarRange field {field}")
+
+
+def day_weight(date_start_str, date_end_str, filter_spec=None):
+    """Number of days in `[date_start_str, date_end_str)` that pass the filter.
+
+    Args:
+        filter_spec: None, or a calendarRange filter spec as used by
+            `mean_daily_stats.compute_daily`. As in Earth Engine, the range is
+            inclusive and wraps around if `end < start`.
+    """
+    start, stop = parse_date(date_start_str), parse_date(date_end_str)
+    if filter_spec is None:
+        return (stop - start).days
+    assert filter_spec["type"] == "calendarRange"
+    field = filter_spec.get("field", "day_of_year")
+    low, high = filter_spec["start"], filter_spec["end"]
+    count = 0
+    for offset in range((stop - start).days):
+        value = calendar_value(start + timedelta(days=offset), field)
+        if low <= value <= high if low <= high else value >= low or value <= high:
+            count += 1
+    return count
+
+
+def weighted_segments(
+    date_start_str,
+    date_end_str,
+    units=segment_units,
+    filter_spec=None,
+    is_cached=None,
+):
+    """Segments of a date range with their day weight.
+
+    Segments with no days passing `filter_spec` are left out, since there is
+    nothing to compute for them.
+
+    Returns:
+        list: (start, end, weight) tuples
+    """
+    result = []
+    for start, end in decompose(date_start_str, date_end_str, units, is_cached):
+        weight = day_weight(start, end, filter_spec)
+        if weight > 0:
+            result.append((start, end, weight))
+    return result
+
+
+def weighted_mean(compute_segment, date_start_str, date_end_str, **kwargs):
+    """Mean over a date range, combined from the means of its segments.
+
+    Args:
+        compute_segment: Function from (start, end) to the mean over that
+            segment, usually cached
+        **kwargs: Passed to `weighted_segments`
+
+    Returns:
+        The day weighted mean of the segment means
+    """
+    total = 0
+    total_weight = 0
+    for start, end, weight in weighted_segments(date_start_str, date_end_str, **kwargs):
+        total += compute_segment(start, end) * weight
+        total_weight += weight
+    return total / total_weight
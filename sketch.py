@@ -0,0 +1,94 @@
+"""Per-pixel histogram sketches of a variable over dates.
+
+A sketch is a dictionary with the bin `edges` and a uint16 `counts` array of
+shape (len(edges) + 1, lat, lon). Bin 0 counts values below `edges[0]`, bin
+`i` values in `[edges[i - 1], edges[i])` and the last bin values of at least
+`edges[-1]`. NaNs are not counted.
+
+Exceedance fractions and quantiles for any threshold are then answered from
+the sketch, without another pass over the per-date grids. They are exact for
+thresholds on bin edges, and interpolated linearly within bins otherwise.
+"""
+
+import numpy as np
+
+max_count = np.iinfo(np.uint16).max
+
+
+def empty_counts(edges, shape):
+    return np.zeros((len(edges) + 1, *shape), dtype=np.uint16)
+
+
+def update_counts(counts, edges, values):
+    """Add a (dates, lat, lon) block of values to the counts, in place."""
+    flat_counts = counts.reshape(len(counts), -1)
+    pixels = np.arange(flat_counts.shape[1])
+    for day in values:
+        day = day.reshape(-1)
+        bins = np.searchsorted(edges, day, side="right")
+        valid = ~np.isnan(day)
+        # each pixel appears once per day, so the fancy increment is safe
+        flat_counts[bins[valid], pixels[valid]] += 1
+    return counts
+
+
+def totals(sketch):
+    # counts never exceed `max_count` in total, so uint16 sums cannot overflow
+    return sketch["counts"].sum(axis=0, dtype=np.uint16)
+
+
+def count_above(sketch, threshold):
+    """Approximate number of dates on which each pixel exceeds `threshold`.
+
+    For thresholds outside the edges, the open ended bins are counted as
+    entirely above (or below) them.
+    """
+    edges, counts = sketch["edges"], sketch["counts"]
+    bin_idx = int(np.searchsorted(edges, threshold, side="right"))
+    above = counts[bin_idx + 1 :].sum(axis=0, dtype=np.uint16).astype(np.float32)
+    if 0 < bin_idx < len(edges):
+        # the part of the bin containing the threshold that is above it
+        low, high = edges[bin_idx - 1], edges[bin_idx]
+        above += counts[bin_idx] * np.float32((high - threshold) / (high - low))
+    elif bin_idx == 0:
+        above += counts[0]
+    elif threshold == edges[-1]:
+        # the last bin holds exactly the values of at least the threshold
+        above += counts[-1]
+    return above
+
+
+def exceedance_fraction(sketch, threshold):
+    """Approximate fraction of dates on which each pixel exceeds `threshold`."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return count_above(sketch, threshold) / totals(sketch)
+
+
+def quantile(sketch, q):
+    """Approximate per-pixel `q` quantile (0 to 1).
+
+    Quantiles falling in the open ended bins are clipped to the outer edges.
+    """
+    edges, counts = sketch["edges"], sketch["counts"]
+    total = totals(sketch)
+    # at least half a count, so that q = 0 finds the first non-empty bin
+    target = np.maximum(np.float32(q) * total, np.float32(0.5))
+    # scan the bins, rather than materializing the cumulative counts
+    running = np.zeros(total.shape, dtype=np.uint16)
+    before = np.zeros(total.shape, dtype=np.uint16)
+    bin_idx = np.zeros(total.shape, dtype=np.uint8)
+    for count in counts[:-1]:
+        running += count
+        below = running < target
+        bin_idx += below
+        np.copyto(before, running, where=below)
+    in_bin = np.take_along_axis(counts, bin_idx[None].astype(np.intp), 0)[0]
+    inner = np.clip(bin_idx, 1, len(edges) - 1)
+    low, high = edges[inner - 1], edges[inner]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        position = np.clip((target - before) / in_bin, 0, 1)
+    result = low + position * (high - low)
+    result[bin_idx == 0] = edges[0]
+    result[bin_idx == len(edges)] = edges[-1]
+    result[total == 0] = np.nan
+    return result
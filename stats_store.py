@@ -0,0 +1,284 @@
+"""Single-file store for all output statistics, chunked spatially.
+
+Layout: an 8 byte magic, the length of a JSON header as a little endian
+uint64, the header, then the data, starting at `data_offset`. Each statistic
+is split into chunks of `chunk_shape` cells (edge chunks are padded), which are
+stored either raw, in which case the whole data section is a memory-mappable
+(stat, chunk row, chunk column, *chunk_shape) array, or zlib compressed, in
+which case an index of (offset, length) pairs per chunk follows the header.
+
+Point and region reads only touch (and decompress) the chunks they overlap.
+Only numpy is needed to read a store.
+"""
+
+import json
+import mmap
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+magic = b"WAGGSTAT"
+version = 1
+alignment = 4096
+
+default_store_path = "output/stats.store"
+
+
+def grid_shape(resolution):
+    return round(180 / resolution), round(360 / resolution)
+
+
+def cell_coordinates(rows, cols, resolution):
+    """Latitude and longitude of grid cells, as laid out by `download`.
+
+    Row 0 is the northernmost row, and column 0 starts at -180°.
+    """
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    return 90 - (rows + 1) * resolution, -180 + cols * resolution
+
+
+def fractional_cell(lat, lon, resolution):
+    """Fractional (row, column) of a location, the inverse of `cell_coordinates`.
+
+    Longitudes are wrapped into [-180, 180).
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    lon = (lon + 180) % 360 - 180
+    return (90 - lat) / resolution - 1, (lon + 180) / resolution
+
+
+def write_store(
+    path,
+    stats,
+    *,
+    resolution=0.25,
+    chunk_shape=(90, 90),
+    compression=None,
+    compression_level=6,
+    metadata=None,
+):
+    """Write statistics to a single chunked store.
+
+    Args:
+        path: Output file
+        stats: Dictionary from stat name to (array, unit), as from
+            `all_stats.all_stats`
+        chunk_shape: (rows, columns) per chunk
+        compression: None, or "zlib" to compress each chunk separately
+        metadata: JSON serializable dictionary stored in the header
+    """
+    if compression not in (None, "zlib"):
+        raise ValueError(f"Unknown compression {compression}")
+    shape = grid_shape(resolution)
+    chunk_rows, chunk_cols = chunk_shape
+    num_chunks = -(-shape[0] // chunk_rows), -(-shape[1] // chunk_cols)
+    padded_shape = num_chunks[0] * chunk_rows, num_chunks[1] * chunk_cols
+    names = list(stats)
+
+    def chunks(stat):
+        padded = np.full(padded_shape, np.nan, dtype=np.float32)
+        padded[: shape[0], : shape[1]] = stat
+        return padded.reshape(
+            num_chunks[0], chunk_rows, num_chunks[1], chunk_cols
+        ).swapaxes(1, 2)
+
+    header = dict(
+        version=version,
+        resolution=resolution,
+        shape=list(shape),
+        chunk_shape=list(chunk_shape),
+        num_chunks=list(num_chunks),
+        dtype="<f4",
+        compression=compression,
+        stats=[dict(name=name, unit=stats[name][1]) for name in names],
+        metadata=metadata or {},
+    )
+    index_bytes = (
+        0 if compression is None else len(names) * int(np.prod(num_chunks)) * 16
+    )
+    # the header contains the data offset, so leave room for its digits
+    header["data_offset"] = 0
+    unpadded = 16 + len(json.dumps(header).encode("utf-8")) + 32 + index_bytes
+    header["data_offset"] = -(-unpadded // alignment) * alignment
+    header_bytes = json.dumps(header).encode("utf-8")
+    index_offset = 16 + len(header_bytes)
+    assert index_offset + index_bytes <= header["data_offset"]
+
+    index = np.zeros((len(names), *num_chunks, 2), dtype="<u8")
+    with open(path, "wb") as f:
+        f.write(magic)
+        f.write(np.uint64(len(header_bytes)).astype("<u8").tobytes())
+        f.write(header_bytes)
+        f.seek(header["data_offset"])
+        for stat_idx, name in enumerate(names):
+            stat = np.asarray(stats[name][0])
+            if stat.shape != shape:
+                raise ValueError(f"Unexpected shape for {name}: {stat.shape}")
+            stat_chunks = chunks(stat)
+            if compression is None:
+                f.write(np.ascontiguousarray(stat_chunks, dtype="<f4").tobytes())
+                continue
+            for row in range(num_chunks[0]):
+                for col in range(num_chunks[1]):
+                    data = zlib.compress(
+                        stat_chunks[row, col].astype("<f4").tobytes(),
+                        compression_level,
+                    )
+                    index[stat_idx, row, col] = f.tell(), len(data)
+                    f.write(data)
+        if compression is not None:
+            f.seek(index_offset)
+            f.write(index.tobytes())
+
+
+class StatsStore:
+    """Read-only access to a store written by `write_store`.
+
+    The file is memory-mapped, so only the chunks that are read are loaded.
+
+    Args:
+        cache_chunks: Number of decompressed chunks to keep, for compressed
+            stores
+    """
+
+    def __init__(self, path=default_store_path, cache_chunks=256):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mmap[:8] != magic:
+            raise ValueError(f"{path} is not a statistics store")
+        header_length = int(np.frombuffer(self._mmap[8:16], dtype="<u8")[0])
+        self.header = json.loads(self._mmap[16 : 16 + header_length])
+        if self.header["version"] != version:
+            raise ValueError(f"Unsupported store version {self.header['version']}")
+        self.resolution = self.header["resolution"]
+        self.shape = tuple(self.header["shape"])
+        self.chunk_shape = tuple(self.header["chunk_shape"])
+        self.num_chunks = tuple(self.header["num_chunks"])
+        self.units = {stat["name"]: stat["unit"] for stat in self.header["stats"]}
+        self.metadata = self.header["metadata"]
+        self._stat_index = {name: idx for idx, name in enumerate(self.units)}
+        data_shape = (len(self.units), *self.num_chunks)
+        if self.header["compression"] is None:
+            self._data = np.ndarray(
+                (*data_shape, *self.chunk_shape),
+                dtype=self.header["dtype"],
+                buffer=self._mmap,
+                offset=self.header["data_offset"],
+            )
+        else:
+            self._index = np.ndarray(
+                (*data_shape, 2),
+                dtype="<u8",
+                buffer=self._mmap,
+                offset=16 + header_length,
+            )
+            self._decompress_chunk = lru_cache(maxsize=cache_chunks)(
+                self._decompress_chunk
+            )
+
+    def close(self):
+        # drop views into the mmap first, or it cannot be closed
+        self._data = self._index = self._decompress_chunk = None
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def stat_names(self):
+        return list(self.units)
+
+    def chunk(self, name, chunk_row, chunk_col):
+        """One (padded) chunk of a statistic, as a float32 array."""
+        stat_idx = self._stat_index[name]
+        if self.header["compression"] is None:
+            return self._data[stat_idx, chunk_row, chunk_col]
+        return self._decompress_chunk(stat_idx, chunk_row, chunk_col)
+
+    def _decompress_chunk(self, stat_idx, chunk_row, chunk_col):
+        offset, length = (int(x) for x in self._index[stat_idx, chunk_row, chunk_col])
+        data = zlib.decompress(self._mmap[offset : offset + length])
+        return np.frombuffer(data, dtype=self.header["dtype"]).reshape(self.chunk_shape)
+
+    def read_cells(self, name, rows, cols):
+        """Values at integer (row, column) grid cells, reading each chunk once."""
+        rows, cols = np.broadcast_arrays(np.asarray(rows), np.asarray(cols))
+        chunk_rows, chunk_cols = (
+            rows // self.chunk_shape[0],
+            cols // self.chunk_shape[1],
+        )
+        if self.header["compression"] is None:
+            return np.array(
+                self._data[
+                    self._stat_index[name],
+                    chunk_rows,
+                    chunk_cols,
+                    rows % self.chunk_shape[0],
+                    cols % self.chunk_shape[1],
+                ]
+            )
+        result = np.empty(rows.shape, dtype=np.float32)
+        chunk_ids = chunk_rows * self.num_chunks[1] + chunk_cols
+        for chunk_id in np.unique(chunk_ids):
+            mask = chunk_ids == chunk_id
+            chunk = self.chunk(name, *divmod(int(chunk_id), self.num_chunks[1]))
+            result[mask] = chunk[
+                rows[mask] % self.chunk_shape[0], cols[mask] % self.chunk_shape[1]
+            ]
+        return result
+
+    def read_point(self, name, lat, lon):
+        """Value of the cell nearest to each location."""
+        rows, cols = fractional_cell(lat, lon, self.resolution)
+        rows = np.clip(np.round(rows).astype(int), 0, self.shape[0] - 1)
+        cols = np.round(cols).astype(int) % self.shape[1]
+        return self.read_cells(name, rows, cols)
+
+    def read_window(self, name, row_slice, col_slice):
+        """A (row, column) window of a statistic, reading only the chunks needed."""
+        row_start, row_stop, _ = row_slice.indices(self.shape[0])
+        col_start, col_stop, _ = col_slice.indices(self.shape[1])
+        result = np.empty(
+            (max(row_stop - row_start, 0), max(col_stop - col_start, 0)),
+            dtype=np.float32,
+        )
+        chunk_rows, chunk_cols = self.chunk_shape
+        for chunk_row in range(row_start // chunk_rows, -(-row_stop // chunk_rows)):
+            for chunk_col in range(col_start // chunk_cols, -(-col_stop // chunk_cols)):
+                chunk = self.chunk(name, chunk_row, chunk_col)
+                top, left = chunk_row * chunk_rows, chunk_col * chunk_cols
+                rows = slice(max(row_start, top), min(row_stop, top + chunk_rows))
+                cols = slice(max(col_start, left), min(col_stop, left + chunk_cols))
+                result[
+                    rows.start - row_start : rows.stop - row_start,
+                    cols.start - col_start : cols.stop - col_start,
+                ] = chunk[
+                    rows.start - top : rows.stop - top,
+                    cols.start - left : cols.stop - left,
+                ]
+        return result
+
+    def read_region(self, name, bounds):
+        """Cells within (min_lon, min_lat, max_lon, max_lat), north row first.
+
+        Bounds are inclusive and snapped to the nearest cells, as with the tile
+        bounds in `download.generate_tiles`.
+        """
+        min_lon, min_lat, max_lon, max_lat = bounds
+        row_stop, col_start = fractional_cell(min_lat, min_lon, self.resolution)
+        row_start, col_stop = fractional_cell(max_lat, max_lon, self.resolution)
+        return self.read_window(
+            name,
+            slice(max(int(np.round(row_start)), 0), int(np.round(row_stop)) + 1),
+            slice(max(int(np.round(col_start)), 0), int(np.round(col_stop)) + 1),
+        )
+
+    def read(self, name):
+        """The whole statistic."""
+        return self.read_window(name, slice(None), slice(None))
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import sketch
+
+edges = np.array([0.0, 10.0, 20.0])
+values = np.array([-5.0, 5.0, 15.0, 25.0, 30.0])
+
+
+def sketch_of(values):
+    counts = sketch.empty_counts(edges, (1,))
+    sketch.update_counts(counts, edges, values.reshape(-1, 1))
+    return dict(edges=edges, counts=counts)
+
+
+@pytest.mark.parametrize("threshold", edges)
+def test_count_above_exact_on_edges(threshold):
+    result = sketch.count_above(sketch_of(values), threshold)
+    assert result[0] == np.count_nonzero(values >= threshold)
+
+
+def test_count_above_outside_edges():
+    values_sketch = sketch_of(values)
+    assert sketch.count_above(values_sketch, -10)[0] == len(values)
+    assert sketch.count_above(values_sketch, 40)[0] == 0
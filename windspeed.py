@@ -1,22 +1,44 @@
-import multiprocessing
+import os
 from datetime import datetime
 
 import ee
-from permacache import permacache
+import numpy as np
+from permacache import drop_if_equal, permacache
 
-from download import download_ee_image
-from sample import compute_date_strs, sampled_values
+import quantize
+from download import download_ee_image, download_stacked_images
+from instrumentation import instrumented
+from reducer import checkpoint_folder, reduce_dates, statistic
+from sample import batches, sample_date_strs, sampled_date_collection, stratum_weights
+from scheduler import job_group, run_jobs
 
 ten_mph_in_mps = 4.4704
 
+high_wind_statistic = statistic(
+    "windspeed_over_10mph",
+    "fraction_above",
+    "wind_speed",
+    "%",
+    threshold=ten_mph_in_mps,
+)
 
-@permacache(
-    "weather-agg-ee/wind_speed/mean_wind_speed_for_date_4", multiprocess_safe=True
+# every 2.5 mph from 0 to 40 mph, in m/s
+wind_speed_sketch_statistic = statistic(
+    "wind_speed_sketch",
+    "histogram",
+    "wind_speed",
+    "m/s",
+    edges=np.arange(0, 40 + 2.5, 2.5) * ten_mph_in_mps / 10,
 )
-def mean_wind_speed_for_date(date_str):
-    start = datetime.now()
-    ee.Initialize()
-    print(f"{start} - Start {date_str}")
+
+# encoding of the per-date grids, see `mean_wind_speed_for_date`
+wind_speed_encoding = quantize.encodings["wind_speed"]
+
+# Number of dates stacked into one multi-band image by the batched functions
+dates_per_request = 8
+
+
+def mean_wind_speed_image(date_str):
     date = ee.Date(date_str)
     era5_land = ee.ImageCollection("ECMWF/ERA5/HOURLY")
 
@@ -31,34 +53,169 @@ def mean_wind_speed_for_date(date_str):
             },
         )
     )
+    return day_collection.mean()
+
+
+@permacache(
+    "weather-agg-ee/wind_speed/mean_wind_speed_for_date_4",
+    key_function=dict(encoding=drop_if_equal(None)),
+    multiprocess_safe=True,
+)
+@instrumented
+def mean_wind_speed_for_date(date_str, encoding=None):
+    """Daily mean wind speed.
+
+    Args:
+        encoding: If given, e.g. `wind_speed_encoding`, the grid is encoded with
+            it, see `quantize`, and cached apart from full precision ones.
+    """
+    start = datetime.now()
+    ee.Initialize()
+    print(f"{start} - Start {date_str}")
     result = download_ee_image(
-        day_collection.mean(), "wind_speed", resolution=0.25, degree_size=45, pbar=False
+        mean_wind_speed_image(date_str),
+        "wind_speed",
+        resolution=0.25,
+        degree_size=45,
+        pbar=False,
+        max_workers=4,
     )
     end = datetime.now()
     print(f"{end} - Finished {date_str}; took {end - start}")
+    if encoding is None:
+        return result
+    return quantize.encode(result, encoding)
+
+
+@permacache(
+    "weather-agg-ee/wind_speed/mean_wind_speed_for_date_4",
+    key_function=dict(encoding=drop_if_equal(None)),
+    parallel=("date_str",),
+    multiprocess_safe=True,
+)
+@instrumented
+def mean_wind_speed_for_dates(date_str, encoding=None):
+    """Batched mean_wind_speed_for_date, sharing its cache entries.
+
+    `date_str` is a list of dates; only the uncached ones are downloaded, in
+    stacks of `dates_per_request` dates per image.
+    """
+    start = datetime.now()
+    ee.Initialize()
+    print(f"{start} - Start {len(date_str)} dates from {date_str[0]}")
+    result = [
+        value if encoding is None else quantize.encode(value, encoding)
+        for batch in batches(date_str, dates_per_request)
+        for value in download_stacked_images(
+            [mean_wind_speed_image(d) for d in batch],
+            "wind_speed",
+            resolution=0.25,
+            degree_size=None,
+            pbar=False,
+            max_workers=4,
+        )
+    ]
+    end = datetime.now()
+    print(f"{end} - Finished {len(date_str)} dates; took {end - start}")
     return result
 
 
+def wind_speed_for_date(date_str):
+    """Daily mean wind speed, encoded with `wind_speed_encoding` unless cached
+    in full precision, before the encoded cache."""
+    if mean_wind_speed_for_date.cache_contains(date_str):
+        return mean_wind_speed_for_date(date_str)
+    return mean_wind_speed_for_date(date_str, encoding=wind_speed_encoding)
+
+
+@permacache("weather-agg-ee/wind_speed/wind_speed_reduction", multiprocess_safe=True)
+def wind_speed_reduction(count, tolerances=None, stratified=False):
+    """High wind fraction and wind speed sketch, in one pass over the dates.
+
+    `tolerances` stops early once the standard errors are within them; see
+    `reducer.reduce_dates`. `stratified` balances the dates across calendar
+    months and years, see `sample.stratified_date_strs`.
+    """
+    date_strs = sample_date_strs(count, stratified)
+    return reduce_dates(
+        lambda date_str: dict(wind_speed=wind_speed_for_date(date_str)),
+        date_strs,
+        [high_wind_statistic, wind_speed_sketch_statistic],
+        checkpoint_path=os.path.join(checkpoint_folder, f"wind_speed_{count}.npz"),
+        tolerances=tolerances,
+        weights=stratum_weights if stratified else None,
+    )
+
+
 @permacache("weather-agg-ee/wind_speed/high_wind_dates_3", multiprocess_safe=True)
 def mean_high_wind_dates(count):
-    sum_vals = sum(
-        value > ten_mph_in_mps
-        for value in sampled_values(mean_wind_speed_for_date, count)
+    value, _ = wind_speed_reduction(count)[high_wind_statistic["name"]]
+    return value
+
+
+def wind_speed_sketch(count=2000):
+    """Per-pixel histogram sketch of the daily mean wind speed, see `sketch`."""
+    value, _ = wind_speed_reduction(count)[wind_speed_sketch_statistic["name"]]
+    return value
+
+
+@instrumented
+def mean_high_wind_dates_server_side(count):
+    """Same as mean_high_wind_dates, but reduced in Earth Engine.
+
+    Only the final fraction grid is downloaded, instead of one grid per date.
+    Cached by the computation, see `download.download_ee_image_by_computation`.
+    """
+    ee.Initialize()
+    collection = sampled_date_collection(mean_wind_speed_image, count)
+    fraction = collection.map(lambda x: x.gt(ten_mph_in_mps)).mean()
+    return download_ee_image(
+        fraction, "wind_speed", resolution=0.25, degree_size=45, cache=True
     )
-    return sum_vals / count
 
 
-def high_wind_days():
+def high_wind_days(server_side=False):
+    if server_side:
+        return mean_high_wind_dates_server_side(2000)
     return mean_high_wind_dates(2000)
 
 
+def check_server_side(count=20):
+    """Maximum absolute difference between the local and server-side modes."""
+    local = mean_high_wind_dates(count)
+    server = mean_high_wind_dates_server_side(count)
+    return np.abs(local - server).max()
+
+
 def mean_wind_speed_for_date_for_parallel(date_str):
     return mean_wind_speed_for_date(date_str)
 
 
+def mean_wind_speed_for_dates_for_parallel(date_strs):
+    mean_wind_speed_for_dates(date_strs, encoding=wind_speed_encoding)
+
+
+def cache_jobs(count=2000, stratified=False):
+    date_strs = [
+        date_str
+        for date_str in sample_date_strs(count, stratified)
+        if not mean_wind_speed_for_date.cache_contains(date_str)
+        and not mean_wind_speed_for_date.cache_contains(
+            date_str, encoding=wind_speed_encoding
+        )
+    ]
+    return [
+        job_group(
+            "wind_speed",
+            mean_wind_speed_for_dates_for_parallel,
+            [(batch,) for batch in batches(date_strs, dates_per_request)],
+            ["windspeed_over_10mph"],
+        )
+    ]
+
+
 def populate_caches():
-    with multiprocessing.Pool(processes=8) as pool:
-        pool.map(mean_wind_speed_for_date_for_parallel, compute_date_strs()[:2000])
+    run_jobs(cache_jobs())
 
 
 if __name__ == "__main__":